@@ -0,0 +1,286 @@
+'''
+Headless micro-benchmarks for the pySDL2gui rendering hot paths.
+
+The benchmarks run under SDL's dummy video driver with the software renderer,
+so they work without a display and give comparable numbers between runs on
+the same machine. Results are saved as JSON in {name: microseconds per call}
+format, and may be compared against a stored baseline.
+
+usage:
+    python bench.py                          run all benchmarks
+    python bench.py font region              run benchmarks matching names
+    python bench.py --save bench.json        save results as a new baseline
+    python bench.py --baseline bench.json    compare against a baseline,
+                                             exiting with 1 on regressions
+'''
+import os, sys, io, json, argparse, contextlib
+from time import perf_counter
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_RENDER_DRIVER', 'software')
+import sdl2, sdl2.ext
+from gui import *
+import gui
+
+LOGICAL_SIZE = 640, 480
+THRESHOLD = 0.2 # default allowed slowdown before a result is a regression
+BENCHMARKS = {}
+
+def benchmark(number=100):
+    'Register a function as a benchmark that is called number times per run'
+    def register(func):
+        BENCHMARKS[func.__name__] = func, number
+        return func
+    return register
+
+
+def setup():
+    '''
+    Create a hidden window, software renderer and the managers used by the
+    benchmarks, without touching audio or controllers
+    '''
+    global screen, images, fonts, inp
+    sdl2.ext.init()
+    window = sdl2.ext.Window('bench', size=LOGICAL_SIZE,
+            flags=sdl2.SDL_WINDOW_HIDDEN)
+    screen = sdl2.ext.renderer.Renderer(window,
+            flags=sdl2.SDL_RENDERER_SOFTWARE, logical_size=LOGICAL_SIZE)
+    Image.renderer = screen
+    images = ImageManager(screen)
+    fonts = FontManager(screen)
+    inp = InputHandler(controller=False)
+    config = {'options': {'logical_size': LOGICAL_SIZE}, 'list': LIST}
+    Region.set_defaults({}, screen, images, fonts)
+    gui.gui.set_globals(config, screen, images, fonts, None)
+    gui.utility.set_globals(config, screen, images, fonts, None)
+
+
+TEXT = 'The quick brown fox jumps over the lazy dog. ' * 8
+LIST = {'area': [0, 0, 1.0, 1.0], 'fill': [0, 0, 0, 100], 'font': 'Roboto.ttf',
+        'fontsize': 24}
+REGIONS = {
+    'fill': {'area': [0.1, 0.1, 0.9, 0.9], 'fill': [200, 200, 200]},
+    'rounded': {'area': [0.1, 0.1, 0.9, 0.9], 'fill': [200, 200, 200],
+            'outline': [0, 0, 0], 'thickness': 4, 'roundness': 12},
+    'patch': {'area': [0.1, 0.1, 0.9, 0.9], 'image': 'nine.png',
+            'patch': [20, 20, 20, 20]},
+    'image': {'area': [0.1, 0.1, 0.9, 0.9], 'image': 'image.png',
+            'imagemode': 'fit', 'imagealign': 'center'},
+    'text': {'area': [0.1, 0.1, 0.9, 0.9], 'font': 'Roboto.ttf', 'fontsize': 24,
+            'wrap': True},
+    'list': {'area': [0.1, 0.1, 0.9, 0.9], 'font': 'Roboto.ttf', 'fontsize': 24,
+            'list': [f'Item number {i}' for i in range(500)]},
+    'bar': {'area': [0.1, 0.1, 0.9, 0.2], 'font': 'Roboto.ttf', 'fontsize': 24,
+            'bar': ['Left', 'image.png', None, 'Right', 'nine.png']},
+}
+
+def region(name):
+    'Create one of the benchmark Regions'
+    r = Region(REGIONS[name])
+    if name == 'text':
+        r.text = TEXT
+    elif name == 'list':
+        r.select = Region(LIST)
+        r.selected = 250
+    return r
+
+
+# RECT
+@benchmark(10000)
+def rect_ops():
+    r = Rect(10, 20, 300, 200)
+    r.copy().inflate(-8)
+    r.inflated(8, 4).clip(Rect(0, 0, 320, 240))
+    r.fitted(Rect(0, 0, 640, 480))
+    r.center = 320, 240
+    r.sdl()
+
+@benchmark(10000)
+def rect_ops_inplace():
+    r = RECT.copy_from(RECT_SRC)
+    r.inflate(-8).crop(RECT_CLIP)
+    r.fit(RECT_FIT)
+    r.center = 320, 240
+    r.sdl()
+RECT, RECT_SRC = Rect(0, 0, 0, 0), Rect(10, 20, 300, 200)
+RECT_CLIP, RECT_FIT = Rect(0, 0, 320, 240), Rect(0, 0, 640, 480)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # RectArray benchmarks need the optional numpy
+
+if numpy:
+    @benchmark(1000)
+    def rectarray_layout():
+        rows = RectArray.rows(RECT_FIT, 20, 24)
+        rows.inflate(-8, -2).crop(RECT_CLIP)
+        keys = RectArray.run(0, 0, [40] * 12, 40, space=4)
+        keys.align('midleft', 10, 200)
+        keys.index(100, 200)
+
+    @benchmark(1000)
+    def rect_layout_loop():
+        rows = [Rect(0, 24*i, 640, 24).inflate(-8, -2).crop(RECT_CLIP)
+                for i in range(20)]
+        keys = []; x = 10
+        for i in range(12):
+            keys.append(Rect(x, 0, 40, 40))
+            keys[-1].midleft = x, 200
+            x += 44
+        [k for k in keys if k.x <= 100 < k.right and k.y <= 200 < k.bottom]
+
+# INPUT
+@benchmark(200)
+def input_process():
+    for v in AXIS_NOISE:
+        AXIS_EVENT.caxis.value = v
+        sdl2.SDL_PushEvent(AXIS_EVENT)
+    inp.process()
+AXIS_NOISE = [(i * 2477) % 6000 - 3000 for i in range(100)] + [25000, 0]
+AXIS_EVENT = sdl2.SDL_Event()
+AXIS_EVENT.type = sdl2.SDL_CONTROLLERAXISMOTION
+
+# FONTS
+@benchmark(5)
+def font_load():
+    FontManager(screen).load('Roboto.ttf', 24)
+
+@benchmark(10000)
+def font_load_cached():
+    fonts.load('Roboto.ttf', 24)
+
+@benchmark(1000)
+def font_width():
+    fonts.load('Roboto.ttf', 24)
+    fonts.width(TEXT)
+
+@benchmark(500)
+def font_draw():
+    fonts.load('Roboto.ttf', 24)
+    fonts.draw('The quick brown fox', 10, 10, (255, 255, 255))
+
+@benchmark(500)
+def font_draw_clipped():
+    fonts.load('Roboto.ttf', 24)
+    fonts.draw(TEXT, 630, 10, (255, 255, 255), align='topright',
+            clip=Rect(10, 10, 620, 40))
+
+@benchmark(200)
+def font_split_lines():
+    fonts.load('Roboto.ttf', 24)
+    fonts._split_lines(TEXT, Rect(0, 0, 400, 400))
+
+# IMAGES
+@benchmark(20)
+def image_load():
+    ImageManager(screen).load('image.png')
+
+@benchmark(10000)
+def image_load_cached():
+    images.load('image.png')
+
+# REGIONS
+@benchmark(200)
+def region_init():
+    Region(REGIONS['text']).text = TEXT
+
+SPECS = {}
+@benchmark(200)
+def region_init_compiled():
+    if not SPECS:
+        SPECS['text'] = Region.compile(REGIONS['text'], LOGICAL_SIZE)
+    Region(SPECS['text']).text = TEXT
+
+def _region_draw(name):
+    regions = []
+    def draw():
+        if not regions:
+            regions.append(region(name))
+        regions[0].draw()
+    draw.__name__ = f'region_draw_{name}'
+    return draw
+
+for _name in REGIONS:
+    benchmark(200)(_region_draw(_name))
+
+
+def run(names=(), repeat=5):
+    '''
+    Run the benchmarks
+
+    names: optional strings, only benchmarks including one of them will run
+    repeat: number of times to run each benchmark, keeping the fastest
+    RETURNS: dict of {name: microseconds per call}
+    '''
+    results = {}
+    for name, (func, number) in BENCHMARKS.items():
+        if names and not any(n in name for n in names):
+            continue
+        best = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            func() # warm up caches before timing
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = perf_counter()
+                for _ in range(number):
+                    func()
+                t = (perf_counter() - start) / number
+            best = t if best == None else min(best, t)
+        screen.clear((0, 0, 0))
+        results[name] = round(best * 1e6, 3)
+        print(f'{name:<28}{results[name]:>12.1f} us')
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''
+    Compare benchmark results against a baseline
+
+    results: dict of {name: microseconds} from run()
+    baseline: dict of {name: microseconds} from an earlier run
+    threshold: allowed slowdown, 0.2 allows results to be 20% slower
+    RETURNS: list of names that regressed
+    '''
+    regressions = []
+    for name, t in results.items():
+        if name not in baseline:
+            continue
+        ratio = t / baseline[name] if baseline[name] else 1
+        mark = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = '  REGRESSION'
+        print(f'{name:<28}{baseline[name]:>12.1f}{t:>12.1f}{ratio:>8.2f}x{mark}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pySDL2gui benchmarks')
+    parser.add_argument('names', nargs='*',
+            help='only run benchmarks including one of these names')
+    parser.add_argument('--repeat', type=int, default=5,
+            help='runs of each benchmark, keeping the fastest')
+    parser.add_argument('--save', help='save results as JSON into this file')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+            help='allowed slowdown against the baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    setup()
+    results = run(args.names, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as inp:
+            baseline = json.load(inp)
+        print(f'\n{"benchmark":<28}{"baseline":>12}{"current":>12}{"ratio":>9}')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
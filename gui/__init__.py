@@ -19,37 +19,89 @@ defaults.json and can be used to change the look and feel of a GUI without
 change the program's code.
 
 CLASSES:
+    AsyncRunLoop: a RunLoop for GUI loops written as asyncio coroutines
     FontManager: class used to load and render fonts onto a pySDL
         render context
     Image: simple class to represent and draw textures and subtexture
         regions onto a pySDL render context
+    FrameStats: measures the time and draw calls of every frame, used to turn
+        input replays into load tests
     ImageManager: class to load and cache images as Image objects in
         texture memory
     InputHandler: handles controller and keyboard input, mapping to simple
         string events such as 'up', 'left', 'A', and 'start'
+    Layers: a read-only view of nested dicts layered over each other, used
+        to merge the theme and Region parameters without copying them
+    ListIndex: a type-ahead search index for filtering long Region lists
+    ListSource: a lazy list provider that creates Region list items on demand
+    ListView: a filtered view of a list that never copies its items
+    MediaIndex: a cached index of the media files in a folder tree, only
+        rescanning changed folders in the background
+    PerfHUD: an on screen overlay showing frame times, draw calls, cache hit
+        rates, and Region draw times, toggled with the L+R+X buttons
+    Tracer: records the phases of each frame and saves them as Chrome
+        trace-event JSON when L+R+Y is pressed or on exit
     Rect: class used to represent and modify Rectangular regions
+    RectArray: many rectangles in one numpy array for bulk layout and hit
+        testing, requires numpy
+    ReplayFinished: raised by InputHandler.process() when an input replay ends
     Region: draws a rectangular region with a backround, outline, image,
         lists, etc. The main building block of pySDL2gui GUIs
+    RegionSpec: a Region definition view already validated by Region.compile()
+    RegionStyle: the validated attributes shared by Regions created from the
+        same definition
+    RunLoop: paces GUI loops, sleeping until input arrives while idle
+    ScreenStack: runs screens on an asyncio event loop, so other coroutines
+        keep running while a menu or keyboard is open
+    Task: a function running in the background on a TaskRunner
+    TaskCancelled: raised by Task.report() once the task has been cancelled
+    TaskRunner: runs work on thread and process pools, reporting progress
+        to the main thread as SDL user events
+    Resources: finds asset files by name, only scanning the assets folder
+        when needed
     SoundManager: class used to load and play sound effects and music
+    Startup: records the startup timeline and runs deferred startup tasks
+    ThemeWatcher: reloads changed theme files and assets while the program
+        runs, restyling only the affected Regions
 
 DATA:
     AXIS_MAP: maps controller axis to input strings ('left', 'start', 'A', etc.)
     BUTTON_MAP: maps controller buttons to input strings 
     KEY_MAP: maps keyboard keys to input strings
+    KEYBOARDS: the keyboard layouts built by keyboard_layout()
+    MEDIA_EXTENSIONS: the file extensions a MediaIndex includes by default
+    MediaFile: namedtuple describing each file of a MediaIndex
     char_map: a string with each character that FontManager should be able to draw
 
 FUNCTIONS:
-    deep_merge: used internally to merge option dicts
+    compile_theme: load theme.json and defaults.json with every Region
+        definition validated, using a cached copy when the files are unchanged
+    deep_merge: merge two option dicts into a new copy
     deep_print: available to display nested dict items or save them to disk
-    deep_update: used internally to update an options dict from a second one
+    deep_update: update an options dict from a second one
     get_color_mod: get the color_mod value of a texture (not working)
     get_text_size: get the size a text string would be if drawn with given font
+    image_size: read the size of an image file from its header
+    region_name: get a short name for a Region to label measurements with
+    hook: replace a method with a measured version, used by PerfHUD and Tracer
     keyboard: displays an onscreen keyboard to enter or edit a text string
+    keyboard_layout: expand a keyboard key list into Region list rows, building
+        each layout only once
+    keyboard_screen: the screen run by keyboard(), for ScreenStack.show()
+    list_item_text: get the searchable text of a Region list item
     make_option_bar: displays a scrolling options menu to edit options
+    option_icons: load the images used by option menu rows
+    option_menu_screen: the screen run by option_menu(), for
+        ScreenStack.show()
+    option_row: create the Region list row for one option of an option menu
     range_list: generate a list of numerical values to select from in a option
         menu, similar to a slider widget
+    replay_session: replay recorded input through a GUI function and measure
+        every frame it draws
     set_color_mod: set the color_mod value of a texture (not working)
+    run_screen: run a screen with a blocking RunLoop until it returns
     set_globals: sets the modules global values within this file's scope
+    unhook: remove a hook installed by hook()
 
 GLOBAL OBJECTS:
     config: a dict full of options and Region definitions loaded from theme.json
@@ -60,6 +112,8 @@ GLOBAL OBJECTS:
     sounds: a SoundManager used to play sounds and music within pySDL2gui
     RESOURCES: a resource manager used to load resources from the assets subfolder
     screen: a sdl2.ext.Renderer context that pySDL2gui displays graphics into
+    startup: a Startup that records the startup timeline and runs deferred
+        startup tasks
 
 pySDL2gui is free software: you can redistribute it and/or modify
 it under the terms of the GNU Lesser General Public License as
@@ -76,69 +130,153 @@ If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os, sys, json
+from time import perf_counter
+_start = perf_counter()
 import sdl2, sdl2.ext
 
 _version = '0.0.1'
-if True:
-    print('pySDL2gui {} running on pySDL2 {}.{}.{} (python {}.{}.{})\n'.format(
-            _version, *sdl2.version_info, *sys.version_info[:3]))
 
 
 global config, screen, fonts, images, inp
 config = screen = fonts = images = inp = None
 from .utility import *
 from .gui import *
+from .perf import *
+startup.start = _start
+startup.spans.append(('import pySDL2gui', _start, perf_counter()))
 
-DEFAULT_SIZE = 480, 320
-
-def init():
-    with open('theme.json') as inp:
-        config = json.load(inp)
-    if os.path.isfile('defaults.json'):
-        with open('defaults.json') as inp:
-            defaults = json.load(inp)
-        config = deep_update(defaults, config)
-    deep_print(config, 'config')
-
-    logical_size = config.get('options', {}).get('logical_size', DEFAULT_SIZE)
-    sdl2.ext.init()
-    mode = sdl2.ext.displays.DisplayInfo(0).current_mode
-    if 'window' in sys.argv:
-        screen_size = config['options'].get('screen_size') or logical_size
-        flags = None
-    else:
-        screen_size = config['options'].get('screen_size') or mode.w, mode.h
-        flags = sdl2.SDL_WINDOW_FULLSCREEN_DESKTOP # TODO should not use fullscreen_desktop on actual device
-    print(f'Current display mode: {mode.w}x{mode.h}@{mode.refresh_rate}Hz')
-    print(f'Logical Size: {logical_size}, Screen Size: {screen_size}')
-
-    window = sdl2.ext.Window("Harbour Master",
-            size=screen_size, flags=flags)
-    screen = sdl2.ext.renderer.Renderer(window,
-            flags=sdl2.SDL_RENDERER_ACCELERATED, logical_size=logical_size)
-    screen.clear((0,0,0))
-    sdl2.ext.renderer.set_texture_scale_quality('linear') #nearest, linear, best
-
-    Image.renderer = screen
-    images = ImageManager(screen)
-    fonts = FontManager(screen)
-    inp = InputHandler()
-    window.show()
-
-    if 'sounds' in config:
-        sounds.init()
-        for k, v in config['sounds'].items():
-            print('loading sound: ', v)
-            sounds.load(v, k)
-    if config['options'].get('music'):
-        sounds.init()
-        sounds.music(config['options']['music'], volume=.3)
+def init(lazy=None):
+    '''
+    Load theme.json and defaults.json with compile_theme(), open the window
+    and create the global objects used by pySDL2gui
+
+    lazy: show the first frame before bringing up audio, music, the game
+        controller, fonts and theme images, which are then loaded one per
+        frame by RunLoop. Defaults to the lazy_start option
+    RETURNS: config, screen, fonts, images, inp
+    '''
+    with startup.phase('load config'):
+        config = compile_theme(cache=None if 'nocache' in sys.argv
+                else THEME_CACHE)
+    options = config.get('options', {})
+    lazy = options.get('lazy_start', False) if lazy == None else lazy
+    verbose = options.get('verbose') or 'verbose' in sys.argv
+    if verbose:
+        print('pySDL2gui {} running on pySDL2 {}.{}.{} (python {}.{}.{})\n'.format(
+                _version, *sdl2.version_info, *sys.version_info[:3]))
+        deep_print(config, 'config')
+
+    with startup.phase('init video'):
+        logical_size = options.get('logical_size', DEFAULT_SIZE)
+        sdl2.ext.init()
+        mode = sdl2.ext.displays.DisplayInfo(0).current_mode
+        if 'window' in sys.argv:
+            screen_size = options.get('screen_size') or logical_size
+            flags = None
+        else:
+            screen_size = options.get('screen_size') or mode.w, mode.h
+            flags = sdl2.SDL_WINDOW_FULLSCREEN_DESKTOP # TODO should not use fullscreen_desktop on actual device
+        if verbose:
+            print(f'Current display mode: {mode.w}x{mode.h}@{mode.refresh_rate}Hz')
+            print(f'Logical Size: {logical_size}, Screen Size: {screen_size}')
+
+        window = sdl2.ext.Window("Harbour Master",
+                size=screen_size, flags=flags)
+        RunLoop.FPS = options.get('fps', RunLoop.FPS)
+        RunLoop.VSYNC = bool(options.get('vsync'))
+        flags = sdl2.SDL_RENDERER_ACCELERATED
+        if RunLoop.VSYNC:
+            flags |= sdl2.SDL_RENDERER_PRESENTVSYNC
+        try:
+            screen = sdl2.ext.renderer.Renderer(window,
+                    flags=flags, logical_size=logical_size)
+        except sdl2.ext.SDLError as e:
+            # no accelerated renderer, such as with SDL_VIDEODRIVER=dummy
+            if verbose:
+                print(f'Using the software renderer: {e}')
+            screen = sdl2.ext.renderer.Renderer(window,
+                    flags=sdl2.SDL_RENDERER_SOFTWARE, logical_size=logical_size)
+        screen.clear((0,0,0))
+        sdl2.ext.renderer.set_texture_scale_quality('linear') #nearest, linear, best
+
+    with startup.phase('create managers'):
+        Image.renderer = screen
+        images = ImageManager(screen)
+        fonts = FontManager(screen)
+        inp = InputHandler(controller=not lazy)
+        hud = PerfHUD(screen, fonts, images,
+                (config.get('defaults', {}).get('font') or 'Roboto.ttf', 14))
+        hud.bind(inp, options.get('hud_combo'))
+        tracer = Tracer(screen, fonts, images, inp, sounds)
+        tracer.bind(inp, options.get('trace_combo'))
+        if options.get('trace') or 'trace' in sys.argv:
+            tracer.enable()
+        window.show()
+
+    tasks = []
+    if 'sounds' in config or options.get('music'):
+        tasks.append(('init audio', sounds.init,
+                options.get('audio_thread', True),
+                options.get('audio_frequency'), options.get('audio_buffer'),
+                options.get('audio_policy')))
+    for k, v in config.get('sounds', {}).items():
+        if verbose:
+            print('adding sound: ', v)
+        sounds.load(v, k) # decoded when first played
+    if options.get('music'):
+        tasks.append(('start music', sounds.music, options['music'], -1, .3))
 
     defaults = config.get('defaults', {})
-    print('Defaults:', defaults)
+    if verbose:
+        print('Defaults:', defaults)
     Region.set_defaults(defaults, screen, images, fonts)
 
+    if options.get('hot_reload') or 'reload' in sys.argv:
+        RunLoop.WATCHER = ThemeWatcher(config, images, fonts,
+                cache=None if 'nocache' in sys.argv else THEME_CACHE)
+
     gui.set_globals(config, screen, images, fonts, inp)
     utility.set_globals(config, screen, images, fonts, inp)
 
+    if lazy:
+        startup.defer('open controller', inp.open_controller)
+        for task in tasks:
+            startup.defer(*task)
+        for font in _theme_assets(config, 'font'):
+            startup.defer(f'load font {font[0]} {font[1]}', fonts.preload, *font)
+        for image in _theme_assets(config, 'image'):
+            startup.defer(f'load image {image}', images.load, image)
+    else:
+        for name, func, *args in tasks:
+            with startup.phase(name):
+                func(*args)
+    if options.get('startup_report') or 'startup' in sys.argv:
+        startup.defer('report', startup.report)
+
     return config, screen, fonts, images, inp
+
+def _theme_assets(config, key):
+    '''
+    Find the fonts or images used by the Region definitions in config
+
+    config: the config dict loaded by init()
+    key: 'font' for a list of (filename, size) tuples or 'image' for a list
+        of image filenames
+    '''
+    defaults = config.get('defaults', {})
+    found = []
+    for v in config.values():
+        if not isinstance(v, Mapping) or 'area' not in v:
+            continue
+        if key == 'font':
+            asset = v.get('font', defaults.get('font')), v.get(
+                    'fontsize', defaults.get('fontsize'))
+            if not all(asset):
+                continue
+        elif isinstance(v.get(key), str):
+            asset = v[key]
+        else:
+            continue
+        if asset not in found:
+            found.append(asset)
+    return found
@@ -19,20 +19,52 @@ defaults.json and can be used to change the look and feel of a GUI without
 change the program's code.
 
 CLASSES:
+    AsyncRunLoop: a RunLoop for GUI loops written as asyncio coroutines
     InputHandler: handles controller and keyboard input, mapping to simple
         string events such as 'up', 'left', 'A', and 'start'
+    ListIndex: a type-ahead search index for filtering long Region lists
+    ListSource: a lazy list provider that creates Region list items on demand
+    ListView: a filtered view of a list that never copies its items
+    MediaIndex: a cached index of the media files in a folder tree, only
+        rescanning changed folders in the background
     Region: draws a rectangular region with a backround, outline, image,
         lists, etc. The main building block of pySDL2gui GUIs
+    RegionSpec: a Region definition view already validated by Region.compile()
+    RegionStyle: the validated attributes shared by Regions created from the
+        same definition
+    RunLoop: paces GUI loops, sleeping until input arrives while idle
+    ScreenStack: runs screens on an asyncio event loop, so other coroutines
+        keep running while a menu or keyboard is open
+    Task: a function running in the background on a TaskRunner
+    TaskCancelled: raised by Task.report() once the task has been cancelled
+    TaskRunner: runs work on thread and process pools, reporting progress
+        to the main thread as SDL user events
+    ThemeWatcher: reloads changed theme files and assets while the program
+        runs, restyling only the affected Regions
 
 FUNCTIONS:
+    compile_theme: load theme.json and defaults.json with every Region
+        definition validated, using a cached copy when the files are unchanged
     keyboard: displays an onscreen keyboard to enter or edit a text string
+    keyboard_layout: expand a keyboard key list into Region list rows, building
+        each layout only once
+    keyboard_screen: the screen run by keyboard(), for ScreenStack.show()
+    list_item_text: get the searchable text of a Region list item
     make_option_bar: displays a scrolling options menu to edit options
+    option_icons: load the images used by option menu rows
+    option_menu_screen: the screen run by option_menu(), for
+        ScreenStack.show()
+    option_row: create the Region list row for one option of an option menu
+    run_screen: run a screen with a blocking RunLoop until it returns
     set_globals: sets the modules global values within this file's scope
 
 DATA:
     AXIS_MAP: maps controller axis to input strings ('left', 'start', 'A', etc.)
     BUTTON_MAP: maps controller buttons to input strings 
     KEY_MAP: maps keyboard keys to input strings
+    KEYBOARDS: the keyboard layouts built by keyboard_layout()
+    MEDIA_EXTENSIONS: the file extensions a MediaIndex includes by default
+    MediaFile: namedtuple describing each file of a MediaIndex
     char_map: a string with each character that FontManager should be able to draw
 
 pySDL2gui is free software: you can redistribute it and/or modify
@@ -48,8 +80,11 @@ License along with pySDL2gui.
 
 If not, see <http://www.gnu.org/licenses/>.
 """
-import os, sys
-import sdl2, sdl2.ext, sdl2.sdlmixer
+import os, sys, json, asyncio, atexit, heapq, pickle, tempfile, threading, weakref
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import sdl2, sdl2.ext
 from .utility import *
 
 try:
@@ -77,6 +112,8 @@ class Region:
     interactive list, or a horizontal toolbar. These attributes are loaded
     from a json file and then passed to the class as a standard dict.
 
+name: optional str used to label the Region in performance measurements
+
 FILL AND OUTLINE  
 area: 4-tuple representing a rectangular area for the region, defined in (left,top,right,bottom) format, not in (x, y, width, height) format like a normal Rect object. It can be in pixels (10,10,200,400), or in screen percent (0.1, 0.1, 0.5, 0.9).
 fill: 3-tuple rgb fill color
@@ -114,10 +151,14 @@ text: text string to draw, which may include newlines
 wrap: set True to allow multiline text wrapping
 
 LIST RENDERING  
-list: a list of items to be displayed and selected from
+list: a list of items to be displayed and selected from. Any object with __len__
+and __getitem__ may be used, such as a ListSource, and only the rows that are
+drawn are ever read or verified
 itemsize: the height that each list item is drawn with
 select: a 3-tuple rgb color for the selected item, or a Region for rendering it
-selectable: a list including the index for each item of the list that may be selected by the user
+selectable: the indexes of list items that may be selected by the user. It is
+stored as a set, but a range or a bytearray bitmap (one bit per item) may be used
+for very long lists
 selected: the currently selected list item, which will be drawn using the color or Region referenced by the select attribute
 
 BARS (toolbars)  
@@ -129,71 +170,144 @@ selectedx: the currently selected list item, or -1 if nothing is selected.
 The selected item will be drawn in the color of or with the Region referenced by the select attribute.
 '''
     DATA = {}; RENDERER=None; IMAGES=None; FONTS=None
+    BAR_CACHE = 256 # maximum number of list row layouts to remember
+    # draws textures rendered with SDL_BLENDMODE_BLEND, whose colors are
+    # already multiplied by their alpha, used by draw_cached()
+    CACHED_BLEND = sdl2.SDL_ComposeCustomBlendMode(
+            sdl2.SDL_BLENDFACTOR_ONE, sdl2.SDL_BLENDFACTOR_ONE_MINUS_SRC_ALPHA,
+            sdl2.SDL_BLENDOPERATION_ADD, sdl2.SDL_BLENDFACTOR_ONE,
+            sdl2.SDL_BLENDFACTOR_ONE_MINUS_SRC_ALPHA, sdl2.SDL_BLENDOPERATION_ADD)
+    CACHED = None # False once the renderer can not draw cached textures
     def __init__(self, data, renderer=None, images=None, fonts=None):
         'Create a new Region for future drawing.'
-        self._dict = deep_merge(self.DATA, data)
-
         self.renderer = renderer or Region.RENDERER
         self.images = images or Region.IMAGES
         self.fonts = fonts or Region.FONTS
+        self.style = RegionStyle.get(data,
+                tuple(self.renderer.logical_size), self.images)
+        self.style.regions.add(self)
+
+        self.area = self.style.area.copy()
+        self._text = self.style._text
+        self._list = self.style._list
+        self._selectable = None
+        self._bar = self._verify_bar('bar', optional=True)
+        self._bar_cache = {}
+        self._cached = {}
+        self._rows = None
+        # scratch Rects reused by draw() instead of creating new ones
+        self._area = Rect(0, 0, 0, 0)
+        self._text_area = Rect(0, 0, 0, 0)
+        self._item_area = Rect(0, 0, 0, 0)
+        self._image_area = Rect(0, 0, 0, 0)
+
+        self.scroll_pos = 0
+        self.scroll_delay = -self.autoscroll*2
+        self.selected = 0
+        self.selectedx = -1
+
+    def __getattr__(self, name):
+        '''
+        Read attributes that are not set on this Region from its shared
+        RegionStyle. Setting one on the Region overrides it for this Region.
+        '''
+        if name == 'style':
+            raise AttributeError(name)
+        return getattr(self.style, name)
 
-        self.area = self._verify_rect('area')
-        self.fill = self._verify_color('fill', optional=True)
-        self.outline = self._verify_color('outline', optional=True)
-        self.thickness = self._verify_int('thickness', 0)
-        self.roundness = self._verify_int('roundness', 0)
-        self.borderx = self._verify_int('border', 0)
-        self.bordery = self._verify_int('bordery', self.borderx) or 0
-        self.borderx = self._verify_int('borderx', self.borderx)
-
-        self.image = self.images.load(self._dict.get('image'))
-        self.imagesize = self._verify_ints('imagesize', 2, None, optional=True)
-        self.imagemode = self._verify_option('imagemode', 
+    def _restyle(self, area, text, items):
+        '''
+        Update the per-instance state copied from the style after the style
+        was reloaded. Used internally
+
+        area, text, items: the style's area, text and list before reloading,
+            which are only replaced if they changed
+        '''
+        style = self.style
+        if area == None or area.tuple() != style.area.tuple():
+            self.area = style.area.copy()
+        if text != style._text:
+            self._text = style._text
+        if items != style._list:
+            self._list = style._list
+        self._bar = self._verify_bar('bar', optional=True)
+        self._bar_cache.clear()
+        self.clear_cached()
+
+    def _verify_values(self, logical_size):
+        '''
+        Verify every attribute in self._dict that does not depend on the
+        renderer, images, or fonts. Used internally.
+
+        logical_size: (width, height) to resolve fractional areas against
+        RETURNS: dict of {attribute name: verified value}
+        '''
+        self.logical_size = logical_size
+        v = {}
+        v['name'] = self._verify_text('name', optional=True)
+
+        v['area'] = self._verify_rect('area')
+        v['fill'] = self._verify_color('fill', optional=True)
+        v['outline'] = self._verify_color('outline', optional=True)
+        v['thickness'] = self._verify_int('thickness', 0)
+        v['roundness'] = self._verify_int('roundness', 0)
+        border = self._verify_int('border', 0)
+        v['bordery'] = self._verify_int('bordery', border) or 0
+        v['borderx'] = self._verify_int('borderx', border)
+
+        v['image'] = self._dict.get('image')
+        v['imagesize'] = self._verify_ints('imagesize', 2, None, optional=True)
+        v['imagemode'] = self._verify_option('imagemode', 
                 ('fit', 'stretch', 'repeat', None), 'fit')
-        self.imagealign = self._verify_option('imagealign', Rect.POINTS, None)
-        self.patch = self._verify_ints('patch', 4, optional=True)
-        self.pimage = self.images.load(self._dict.get('pimage'))
-        if self.patch and not self.pimage:
-            self.pimage = self.image
-            self.image = None
+        v['imagealign'] = self._verify_option('imagealign', Rect.POINTS, None)
+        v['patch'] = self._verify_ints('patch', 4, optional=True)
+        v['pimage'] = self._dict.get('pimage')
 
-        self.pattern = False
-        
         # TODO figure out how to use default/system fonts
-        self.font = self._verify_file('font', optional=True)
-        self.fontsize = self._verify_int('fontsize', 30)
-        self.fontcolor = self._verify_color('fontcolor', (255,255,255))
-        self.fontoutline = self._verify_outline('fontoutline', None, True)
-        self._text = self._verify_text('text', optional=True)
-        self.wrap = self._verify_bool('wrap', False, True)
-        self.linespace = self._verify_int('linespace', 0, True)
-        self.align = self._verify_option('align', Rect.POINTS, 'topleft')
-
-        self.list = self._verify_list('list', optional=True)
-        self.selectable = None
-        self.imagelist = 0 ## TODO
-        self.ilistalign = 0 ## TODO
-        self.itemsize = self._verify_int('itemsize', None, True)
-        self.select = self._verify_color('select', optional=True)
+        v['font'] = self._verify_file('font', optional=True)
+        v['fontsize'] = self._verify_int('fontsize', 30)
+        v['fontcolor'] = self._verify_color('fontcolor', (255,255,255))
+        v['fontoutline'] = self._verify_outline('fontoutline', None, True)
+        v['_text'] = self._verify_text('text', optional=True)
+        v['wrap'] = self._verify_bool('wrap', False, True)
+        v['linespace'] = self._verify_int('linespace', 0, True)
+        v['align'] = self._verify_option('align', Rect.POINTS, 'topleft')
 
-        self.click_sound = self._verify_text('click_sound', optional=True)
-        self.cancel_sound = self._verify_text('cancel_sound', optional=True)
+        v['_list'] = self._verify_list('list', optional=True)
+        v['itemsize'] = self._verify_int('itemsize', None, True)
+        v['select'] = self._verify_color('select', optional=True)
 
-        self.scrollable = self._verify_bool('scrollable', False, True)
-        self.autoscroll = self._verify_int('autoscroll', 0, True)
+        v['click_sound'] = self._verify_text('click_sound', optional=True)
+        v['cancel_sound'] = self._verify_text('cancel_sound', optional=True)
 
-        self.barspace = self._verify_int('barspace', 4)
-        self.barwidth = self._verify_int('barwidth', 0, optional=True)
-        self._bar = self._verify_bar('bar', optional=True)
+        v['scrollable'] = self._verify_bool('scrollable', False, True)
+        v['autoscroll'] = self._verify_int('autoscroll', 0, True)
+
+        v['barspace'] = self._verify_int('barspace', 4)
+        v['barwidth'] = self._verify_int('barwidth', 0, optional=True)
 
-        if self._text and self.list:
+        if v['_text'] and v['_list']:
             raise Exception('Cannot define text and a list')
+        return v
 
-        self.scroll_pos = 0
-        self.scroll_delay = -self.autoscroll*2
-        self.selected = 0
-        self.selectedx = -1
-        print(self.fontoutline)
+    def compile(data, logical_size, defaults=None):
+        '''
+        Validate a Region definition once, so Regions can later be created
+        from it without validating it again
+
+        data: a dict of Region parameters
+        logical_size: (width, height) of the renderer the Regions will draw on,
+            used to resolve fractional areas
+        defaults: dict of default Region parameters to layer data over,
+            Region.DATA by default
+        RETURNS: a RegionSpec, which may be passed to Region() in place of data
+        '''
+        region = Region.__new__(Region)
+        region._dict = spec = RegionSpec(
+                Region.DATA if defaults == None else defaults, data)
+        spec.logical_size = tuple(logical_size)
+        spec.values = region._verify_values(spec.logical_size)
+        return spec
 
     def set_defaults(data, renderer, images, fonts):
         '''
@@ -219,16 +333,16 @@ The selected item will be drawn in the color of or with the Region referenced by
         image: override Region's image, used internally
         '''
 
-        area = area or self.area.copy()
+        area = self._area.copy_from(area or self.area)
         image = image or self.image
         screen.blendmode = sdl2.SDL_BLENDMODE_BLEND
 
         # FILL AND OUTLINE  
         if self.patch:
             self._draw_patch(area, self.pimage)
-            area = Rect.from_corners(
-                area.x + self.patch[0], area.y + self.patch[1], 
-                area.right - self.patch[2], area.bottom - self.patch[3])
+            area.update(area.x + self.patch[0], area.y + self.patch[1],
+                area.width - self.patch[0] - self.patch[2],
+                area.height - self.patch[1] - self.patch[3])
 
         elif self.fill and self.outline:
             if self.roundness and sdlgfx:
@@ -252,7 +366,6 @@ The selected item will be drawn in the color of or with the Region referenced by
                     area.x, area.y, area.right, area.bottom,
                     self.roundness, *self.fill)
             else:
-                print(self.fill)
                 self.renderer.fill(area.sdl(), self.fill)
 
         elif self.outline:
@@ -271,7 +384,7 @@ The selected item will be drawn in the color of or with the Region referenced by
         # RENDER IMAGE
         if self.image and not self.patch:
             image = self.image #s.load(self.image)
-            dest = Rect.from_sdl(image.srcrect)
+            dest = self._image_area.copy_from(image.srcrect)
             if self.imagesize:
                 dest.size = self.imagesize
             
@@ -288,9 +401,10 @@ The selected item will be drawn in the color of or with the Region referenced by
 
             else:
                 dest.topleft = area.topleft
-                image.draw_in(dest.clip(area).tuple())
+                image.draw_in(dest.crop(area).tuple())
 
-        text_area = area.inflated(-self.borderx*2, -self.bordery*2)
+        text_area = self._text_area.copy_from(area).inflate(
+                -self.borderx*2, -self.bordery*2)
 
         if self.font and self.fontsize:
             self.fonts.load(self.font, self.fontsize)
@@ -320,30 +434,34 @@ The selected item will be drawn in the color of or with the Region referenced by
 
         # RENDER LIST
         elif self.list:
+            items = self.list
+            length = len(items)
             itemsize = self.itemsize or self.fonts.height + self.bordery
             self.page_size = area.height // itemsize
-            self.selected = self.selected % len(self.list)
+            self.selected = self.selected % length
 
             self.fonts.load(self.font, self.fontsize)
-            if len(self.list) > self.page_size:
+            if length > self.page_size:
                 start = max(0, min(self.selected - self.page_size//3,
-                        len(self.list)-self.page_size))
+                        length-self.page_size))
             else:
                 start = 0
 
-            irect = text_area.copy()
+            irect = self._item_area.copy_from(text_area)
             irect.height = itemsize
-            i = start
-            for t in self.list[start: start + self.page_size]:
+            layout = getattr(items, 'layout', None)
+            # draw_cached() records the rows and draws them unselected
+            selected = self.selected if self._rows == None else None
+            for i in range(start, min(start + self.page_size, length)):
+                t = self._verify_item('list', i, items[i])
                 if isinstance(t, (list, tuple)):
-                    bar = self._verify_bar(None, t, irect)
-                    if i == self.selected and self.selectedx >= 0:
+                    t = bar = self._layout_row(t, irect, layout)
+                    if i == selected and self.selectedx >= 0:
                         x = self.selectedx
                     else: x = None
                     self._draw_bar(irect, bar, x)
-                elif self.selected == i:
+                elif selected == i:
                     if isinstance(self.select, Region):
-                        r = irect.inflated(self.borderx*2, self.bordery*2)
                         self.select.draw(irect, t)
                         self.fonts.load(self.font, self.fontsize)
                     else:
@@ -352,17 +470,144 @@ The selected item will be drawn in the color of or with the Region referenced by
                 else:           
                     self.fonts.draw(t,  *irect.midleft, self.fontcolor, 255,
                             "midleft", text_area, outline=self.fontoutline)
+                if self._rows != None:
+                    self._rows.append((i, irect.copy(), t))
                 irect.y += itemsize
-                i += 1
 
-    def update(self, inp):
+    def draw_cached(self, key=None):
         '''
-        Update current region based on given input and autoscrolling parameters
+        Draw this Region from a texture rendered once for each key, and then
+        draw only the selected list item over it, after covering its cached
+        copy with the Region's background. Meant for Regions whose list fits
+        in the Region and rarely changes, such as the keys of an on screen
+        keyboard. Falls back to draw() when the renderer lacks render
+        targets or premultiplied alpha blending
+
+        key: hashable value naming the Region's current contents, such as
+            a keyboard's shift state. Call clear_cached() after changing
+            the contents without changing the key
+        '''
+        cached = self._cached.get((key, self.area.tuple()))
+        if cached == None:
+            cached = self._render_cached(key)
+            if cached == None:
+                return self.draw()
+        texture, blank, rows = cached
+        area = self.area
+        # copied through the renderer, so measurements count the draw
+        self.renderer.copy(texture.contents,
+                sdl2.SDL_Rect(0, 0, area.width, area.height), area.sdl())
+
+        if not rows:
+            return
+        selected = self.selected % len(self.list)
+        self.fonts.load(self.font, self.fontsize)
+        for i, irect, item in rows:
+            if i != selected:
+                continue
+            if not isinstance(item, str):
+                x = self.selectedx
+                if x >= 0:
+                    self._draw_blank(blank, item[x][0])
+                    self._draw_bar(irect, item[x:x+1], 0)
+                continue
+            self._draw_blank(blank, irect)
+            if isinstance(self.select, Region):
+                self.select.draw(irect, item)
+            else:
+                self.fonts.draw(item, *irect.midleft, self.select, 255,
+                        'midleft', area, outline=self.fontoutline)
+
+    def _draw_blank(self, blank, rect):
+        '''
+        Cover the cached copy of a list item with the background behind it,
+        so the selection is not drawn over it. Used internally
+        '''
+        rect = rect.clip(self.area)
+        if rect.width > 0 and rect.height > 0:
+            self.renderer.copy(blank.contents, rect.moved(
+                    -self.area.x, -self.area.y).sdl(), rect.sdl())
+
+    def _render_cached(self, key):
+        '''
+        Render this Region without its selection into a new texture for
+        draw_cached(), remembering where each list row was drawn, and its
+        background without the list into a second texture. Used internally
+
+        RETURNS: (texture, blank, rows) or None if the renderer can not cache
+        '''
+        renderer = self.renderer.sdlrenderer
+        if Region.CACHED == None:
+            Region.CACHED = bool(sdl2.SDL_RenderTargetSupported(renderer))
+        if not Region.CACHED:
+            return None
+        texture = self._render_texture()
+        rows, self._rows = self._rows, None
+        if texture == None:
+            return None
+        blank = self._render_texture(blank=True)
+        if blank == None:
+            sdl2.SDL_DestroyTexture(texture)
+            return None
+
+        x, y = self.area.topleft
+        rows = [(i, irect.move(x, y), item if isinstance(item, str) else
+                [(dest.moved(x, y), v) for dest, v in item])
+                for i, irect, item in rows]
+        self._cached[key, self.area.tuple()] = texture, blank, rows
+        return texture, blank, rows
+
+    def _render_texture(self, blank=False):
+        '''
+        Draw this Region into a new target texture, recording its list rows
+        in _rows, or only its background when blank. Used internally
+
+        RETURNS: the texture, or None if the renderer can not cache
+        '''
+        renderer = self.renderer.sdlrenderer
+        w, h = self.area.size
+        texture = sdl2.SDL_CreateTexture(renderer, sdl2.SDL_PIXELFORMAT_ARGB8888,
+                sdl2.SDL_TEXTUREACCESS_TARGET, w, h)
+        if not texture:
+            return None
+        if sdl2.SDL_SetTextureBlendMode(texture, Region.CACHED_BLEND) < 0:
+            sdl2.SDL_DestroyTexture(texture)
+            Region.CACHED = False
+            return None
+
+        target = sdl2.SDL_GetRenderTarget(renderer)
+        sdl2.SDL_SetRenderTarget(renderer, texture)
+        sdl2.SDL_SetRenderDrawColor(renderer, 0, 0, 0, 0)
+        sdl2.SDL_RenderClear(renderer)
+        items = self._list
+        if blank:
+            self._list = None
+        else:
+            self._rows = []
+        try:
+            self.draw(Rect(0, 0, w, h))
+        finally:
+            self._list = items
+            sdl2.SDL_SetRenderTarget(renderer, target)
+        return texture
+
+    def clear_cached(self):
+        'Destroy the textures rendered by draw_cached()'
+        for texture, blank, rows in self._cached.values():
+            sdl2.SDL_DestroyTexture(texture)
+            sdl2.SDL_DestroyTexture(blank)
+        self._cached.clear()
+
+    def update(self, inp, drained=False):
+        '''
+        Update current region based on given input and autoscrolling parameters.
+        Call it once per frame, so autoscrolling keeps its speed
 
         inp: reference to an gui.InputHandler to receive input
+        drained: True if each input from inp.drain() is passed to handle()
+            instead, so only autoscrolling is done here
         RETURNS: True if screen should redraw, otherwise False
         '''
-        updated = False
         if self.autoscroll:
             self.scroll_delay += 1
             if self.scroll_delay >= self.autoscroll:
@@ -371,31 +616,42 @@ The selected item will be drawn in the color of or with the Region referenced by
                 if self.scroll_pos > len(self.text):
                     self.scroll_delay = -self.autoscroll
                     self.scroll_pos = 0
-                updated = True
+                return True
+            return False
+        elif drained:
+            return False
+        return self.handle(inp.pressed)
+
+    def handle(self, pressed):
+        '''
+        Scroll the text or move the list selection of this Region for one
+        input, such as each one returned by inp.drain(). Autoscrolling
+        Regions ignore input
+
+        pressed: input string, such as 'up' or 'down'
+        RETURNS: True if screen should redraw, otherwise False
+        '''
+        updated = False
+        if self.autoscroll:
+            return False
 
-        elif self.text and self.scrollable:
-            if inp.pressed == 'up':
+        if self.text and self.scrollable:
+            if pressed == 'up':
                 updated = True
                 self.scroll_pos -= 1
-            elif inp.pressed == 'down':
+            elif pressed == 'down':
                 self.scroll_pos += 1
                 updated = True
             self.scroll_pos = min(max(0, self.scroll_pos), len(self.text)-1)
 
         elif self.list:
-            l = len(self.list)
-            selectable = self.selectable or range(l)
             selected = self.selected
-            if inp.pressed == 'up':
-                selected = (selected-1) % l
-                while (selected) % l not in selectable:
-                    selected = (selected-1) % l
+            if pressed == 'up':
+                selected = self._next_selectable(selected, -1)
                 sounds.play(self.click_sound)
                 updated = True
-            elif inp.pressed == 'down':
-                selected = (selected+1) % l
-                while (selected) % l not in selectable:
-                    selected = (selected+1) % l
+            elif pressed == 'down':
+                selected = self._next_selectable(selected, 1)
                 sounds.play(self.click_sound)
                 updated = True
             if updated:
@@ -419,12 +675,77 @@ The selected item will be drawn in the color of or with the Region referenced by
             self._text = val.split('\n')
         #print(f'text set to:\n{self._text}')
     
+    @property
+    def list(self):
+        return self._list
+    @list.setter
+    def list(self, val):
+        self._list = self._verify_list(None, val, optional=True)
+        self._bar_cache.clear()
+
+    @property
+    def selectable(self):
+        return self._selectable
+    @selectable.setter
+    def selectable(self, val):
+        'Store selectable indexes as a set, range, or bitmap for fast lookups'
+        if val == None or isinstance(val, (set, frozenset, range, bytes, bytearray)):
+            self._selectable = val
+        else:
+            self._selectable = frozenset(val)
+
+    def is_selectable(self, index):
+        '''
+        Check whether the list item at index may be selected by the user
+
+        index: int index into the list
+        RETURNS: True if the item can be selected
+        '''
+        s = self._selectable
+        if s == None:
+            return True
+        elif isinstance(s, (bytes, bytearray)):
+            return index >> 3 < len(s) and bool(s[index >> 3] & (1 << (index & 7)))
+        return index in s
+
+    def _next_selectable(self, index, step):
+        '''
+        Find the next selectable list index from index, moving by step and
+        wrapping around the list. Used internally.
+        '''
+        l = len(self.list)
+        for _ in range(l):
+            index = (index + step) % l
+            if self.is_selectable(index):
+                return index
+        return self.selected
+
     @property
     def bar(self):
         return self._bar
     @bar.setter
     def bar(self, val):
         self._bar = self._verify_bar(None, val)
+        self._bar_cache.clear()
+
+    def _layout_row(self, row, area, layout=None):
+        '''
+        Return the bar layout for a list row, reusing the cached layout while
+        the row contents, its area, and the font and bar settings are unchanged.
+        Used internally.
+        '''
+        key = (tuple(row), area.tuple(), self.font, self.fontsize,
+                self.barspace, self.barwidth)
+        bar = self._bar_cache.get(key)
+        if bar == None:
+            if len(self._bar_cache) >= self.BAR_CACHE:
+                self._bar_cache.clear()
+            if layout:
+                bar = layout(row, area)
+            else:
+                bar = self._verify_bar(None, row, area)
+            self._bar_cache[key] = bar
+        return bar
 
     def _verify_bar(self, name, default=None, area=None, optional=True):
         '''
@@ -489,6 +810,7 @@ The selected item will be drawn in the color of or with the Region referenced by
         #mode, self.renderer.blendmode = self.renderer.blendmode, sdl2.SDL_BLENDMODE_BLEND
         #self.fonts.load(self.font, self.fontsize)
 
+        fit = self._image_area
         for i, (dest, item) in enumerate(bar):
             if i == selected:
                 if isinstance(self.select, Region):
@@ -497,7 +819,6 @@ The selected item will be drawn in the color of or with the Region referenced by
                     else:
                         color = None
                         text = item; image = None
-                    r = dest.inflated(self.borderx*2, self.bordery*2)
                     self.select.draw(dest, text, image)
                     self.fonts.load(self.font, self.fontsize)
                 
@@ -505,7 +826,7 @@ The selected item will be drawn in the color of or with the Region referenced by
                     #self.renderer.fill(dest.tuple(), [0,0,255,100])
 
                     if isinstance(item, Image):
-                        item.draw_in(Rect.from_sdl(item.srcrect).fitted(dest).tuple())
+                        item.draw_in(fit.copy_from(item.srcrect).fit(dest).tuple())
                     else:
                         x, y = dest.center
                         self.fonts.draw(item, x, y,
@@ -513,7 +834,7 @@ The selected item will be drawn in the color of or with the Region referenced by
                                 outline=self.fontoutline)
 
             elif isinstance(item, Image):
-                item.draw_in(Rect.from_sdl(item.srcrect).fitted(dest).tuple())
+                item.draw_in(fit.copy_from(item.srcrect).fit(dest).tuple())
             else:
                 x, y = dest.center
                 self.fonts.draw(item, x, y,self.fontcolor, 255, 'center',
@@ -521,11 +842,9 @@ The selected item will be drawn in the color of or with the Region referenced by
         #self.renderer.blendmode = mode
 
     def _verify_outline(self, name, default, optional):
-        print(name, default)
         val = self._dict.get(name, default)
         if val == None and optional: return None
 
-        print(val)
         if isinstance(val, (list, tuple)) and len(val) == 2:
             color = self._verify_color(None, val[0])
             thickness = self._verify_int(None, val[1])
@@ -544,8 +863,8 @@ The selected item will be drawn in the color of or with the Region referenced by
         '''
         Draw 9-patch image in given area
         ''' 
-        target = area.copy()
-        bounds = Rect.from_sdl(image.srcrect)
+        target = area
+        bounds = self._image_area.copy_from(image.srcrect)
         texture = image.texture
 
         self.renderer.copy(texture,  # TOP
@@ -609,11 +928,12 @@ The selected item will be drawn in the color of or with the Region referenced by
         except TypeError:
             print('Region area not iterable')
             raise
+        val = list(val)
         for i, p in enumerate(val):
             if not isinstance(p, (int, float)):
                 raise Exception(f'point {i}{p} is not a number')
             if type(p)==float and 0 < p <= 1:
-                val[i] = p * self.renderer.logical_size[i % 2]
+                val[i] = p * self.logical_size[i % 2]
         val = Rect.from_corners(*val)
         #print(f'{name}: {val}')
         return val
@@ -702,18 +1022,23 @@ The selected item will be drawn in the color of or with the Region referenced by
             raise(f'{name} is not text')
     
     def _verify_list(self, name, default=None, optional=False):
-        'verify that value of self._dict[name] is valid list'
-
+        '''
+        verify that value of self._dict[name] is a list or lazy list provider.
+        Items are verified later by _verify_item(), and only when drawn
+        '''
         val = self._dict.get(name, default)
-        if val == None and optional: return None
+        if val is None and optional: return None
 
-        if not isinstance(val, (list, tuple)):
-            raise Exception(f'{name} is not a list')
-        for i, v in enumerate(val):
-            if isinstance(v, (list, tuple)):
-                self._verify_bar(None, v, Rect(0,0,100,100))
-            elif not isinstance(v, str):
-                raise Exception(f'{name}[{i}] == {v}, not a string')
+        if (isinstance(val, (str, Mapping)) or not hasattr(val, '__len__')
+                or not hasattr(val, '__getitem__')):
+            raise Exception(f'{name or "list"} is not a list')
+        return val
+
+    def _verify_item(self, name, index, val):
+        'verify that a list item is a valid str or bar list'
+
+        if not isinstance(val, (str, list, tuple)):
+            raise Exception(f'{name}[{index}] == {val}, not a string')
         return val
     
     def _verify_ints(self, name, count, default=None, optional=False):
@@ -731,6 +1056,479 @@ The selected item will be drawn in the color of or with the Region referenced by
                 raise Exception(f'{name}[{i}] == {v}, not an int')
         return val
 
+class RegionStyle:
+    '''
+    The validated attributes shared by every Region created from the same
+    definition, with its image and pimage already loaded. RegionStyle.get()
+    makes one per RegionSpec and keeps it on the spec, so creating more
+    Regions from a compiled theme entry skips merging, validation and image
+    loading. Regions only hold per-instance state, such as area, text, list,
+    selected and scroll position, and read everything else from their style.
+
+    spec: a RegionSpec from Region.compile()
+    images: the ImageManager to load images with
+    regions: a weak set of the Regions created from this style
+    '''
+    def __init__(self, spec, images):
+        self.images = images
+        self.regions = weakref.WeakSet()
+        self.reload(spec)
+
+    def reload(self, spec):
+        '''
+        Replace every attribute with those of a newly compiled spec, and
+        update the Regions created from this style. Used by ThemeWatcher to
+        restyle Regions while the program runs
+
+        spec: a RegionSpec from Region.compile()
+        '''
+        old = getattr(self, 'area', None), getattr(self, '_text', None), \
+                getattr(self, '_list', None)
+        self._dict = spec
+        spec.style = self
+        for k, v in spec.values.items():
+            setattr(self, k, v)
+        self.logical_size = spec.logical_size
+
+        images = self.images
+        self.image = images.load(self.image)
+        self.pimage = images.load(self.pimage)
+        if self.patch and not self.pimage:
+            self.pimage = self.image
+            self.image = None
+        self.pattern = False
+        self.imagelist = 0 ## TODO
+        self.ilistalign = 0 ## TODO
+        for region in self.regions:
+            region._restyle(*old)
+
+    def get(data, logical_size, images):
+        '''
+        Get the shared RegionStyle for a Region definition
+
+        data: a RegionSpec, or a dict of Region parameters
+        logical_size: (width, height) of the renderer the Region draws on
+        images: the ImageManager to load images with
+        RETURNS: the RegionSpec's RegionStyle, made on first use, or a new
+            RegionStyle for a plain dict or a spec compiled for another size
+        '''
+        if isinstance(data, RegionSpec) and data.logical_size == logical_size:
+            if data.style == None or data.style.images is not images:
+                RegionStyle(data, images)
+            return data.style
+        return RegionStyle(Region.compile(data, logical_size), images)
+
+
+class RegionSpec(Layers):
+    '''
+    A Region definition that has already been validated by Region.compile().
+    It is still a read-only view of the Region parameters layered over the
+    defaults, so it can be read like any other theme entry, and it also
+    holds the verified attribute values that Region() uses instead of
+    validating the parameters again.
+
+    values: dict of {attribute name: verified value}
+    logical_size: the (width, height) its areas were resolved against. Regions
+        drawn at a different logical size validate the dict as usual
+    style: the RegionStyle shared by Regions created from it, not pickled
+    '''
+    values = None
+    logical_size = None
+    style = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('style', None)
+        state['layers'] = self.layers
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+DEFAULT_SIZE = 480, 320
+THEME_CACHE = 'theme.cache'
+THEME_VERSION = 3 # change when RegionSpec values change to ignore old caches
+
+def compile_theme(logical_size=None, theme='theme.json',
+        defaults='defaults.json', cache=THEME_CACHE):
+    '''
+    Load theme.json over defaults.json and compile every Region definition
+    into a RegionSpec, validating it and resolving its areas and asset paths
+    only once. The result is kept in a binary cache keyed by the modification
+    times of the json files and the logical size, so later launches read the
+    compiled theme instead of parsing and validating it again.
+
+    logical_size: (width, height) to resolve fractional areas against, or
+        the logical_size option of the theme by default
+    theme: filename of the theme json file
+    defaults: filename of the defaults json file, used if it exists
+    cache: filename of the cache file, or None to always compile
+    RETURNS: the config dict
+    '''
+    files = [f for f in (defaults, theme) if f == theme or os.path.isfile(f)]
+    key = (THEME_VERSION, tuple(files),
+            tuple(os.stat(f).st_mtime_ns for f in files),
+            tuple(logical_size) if logical_size else None)
+    if cache and os.path.isfile(cache):
+        try:
+            with open(cache, 'rb') as inp:
+                compiled = pickle.load(inp)
+            if compiled['key'] == key:
+                RESOURCES.paths.update(compiled['paths'])
+                return compiled['config']
+        except Exception as e:
+            print(f'Ignoring theme cache {cache}: {e}')
+
+    with open(theme) as inp:
+        config = json.load(inp)
+    if theme != files[0]:
+        with open(files[0]) as inp:
+            config = dict(Layers(json.load(inp), config))
+
+    size = tuple(logical_size or config.get('options', {}).get(
+            'logical_size', DEFAULT_SIZE))
+    region_defaults = config.get('defaults', {})
+    paths = {}
+    for k, v in config.items():
+        if not isinstance(v, Mapping) or 'area' not in v:
+            continue
+        try: # name Region definitions for measurements
+            spec = Region.compile(Layers({'name': k}, v), size, region_defaults)
+        except Exception as e:
+            raise Exception(f'{theme}: {k}: {e}')
+        for asset in (spec.values['font'], spec.values['image'],
+                spec.values['pimage']):
+            if isinstance(asset, str):
+                try:
+                    paths[asset] = RESOURCES.get_path(asset)
+                except KeyError:
+                    pass
+        config[k] = spec
+
+    if cache:
+        try:
+            with open(cache + '.tmp', 'wb') as out:
+                pickle.dump({'key': key, 'paths': paths, 'config': config}, out)
+            os.replace(cache + '.tmp', cache)
+        except OSError as e:
+            print(f'Cannot save theme cache {cache}: {e}')
+    return config
+
+
+class ThemeWatcher:
+    '''
+    A development mode that reloads the theme while the program runs, so
+    theme.json can be tuned without restarting. poll() compares the
+    modification times of the json files and of the fonts and images the
+    theme uses, at most every INTERVAL ms. When a json file changes the
+    theme is compiled again, and only Region definitions whose parameters
+    changed are restyled, updating every Region made from them in place.
+    When a font or image changes only that asset is unloaded, and the
+    styles using it reload it. Unchanged assets stay loaded.
+
+    gui.init() creates one as RunLoop.WATCHER when the hot_reload option or
+    the reload argument is given, and RunLoop.tick() polls it.
+
+    config: the config dict from compile_theme(), updated in place
+    images: the ImageManager the theme images were loaded with
+    fonts: the FontManager the theme fonts were loaded with
+    theme: filename of the theme json file
+    defaults: filename of the defaults json file
+    cache: filename of the theme cache to update, or None
+    '''
+    INTERVAL = 500 # ms between checks
+    def __init__(self, config, images, fonts, theme='theme.json',
+            defaults='defaults.json', cache=THEME_CACHE):
+        self.config = config
+        self.images = images
+        self.fonts = fonts
+        self.theme = theme
+        self.defaults = defaults
+        self.cache = cache
+        self.next_poll = 0
+        self.mtimes = self._stat()
+
+    def _stat(self):
+        'Find the watched files and their modification times. Used internally'
+        self.assets = {}
+        for v in self.config.values():
+            if isinstance(v, RegionSpec):
+                for asset in (v.values['font'], v.values['image'],
+                        v.values['pimage']):
+                    if isinstance(asset, str) and asset not in self.assets:
+                        try:
+                            self.assets[asset] = RESOURCES.get_path(asset)
+                        except KeyError:
+                            pass
+        files = [self.theme, self.defaults, *self.assets.values()]
+        return {f: _mtime(f) for f in files}
+
+    def poll(self):
+        '''
+        Check the watched files, at most every INTERVAL ms, and reload the
+        ones that changed
+
+        RETURNS: list of the config keys that were reloaded
+        '''
+        now = sdl2.SDL_GetTicks()
+        if now < self.next_poll:
+            return []
+        self.next_poll = now + self.INTERVAL
+        changed = {f for f, t in self.mtimes.items() if _mtime(f) != t}
+        if not changed:
+            return []
+
+        reloaded = []
+        if self.theme in changed or self.defaults in changed:
+            reloaded += self._reload_theme()
+        assets = [a for a, f in self.assets.items() if f in changed]
+        if assets:
+            reloaded += self._reload_assets(assets)
+        self.mtimes = self._stat()
+        return reloaded
+
+    def _reload_theme(self):
+        '''
+        Compile the theme again and replace only the entries that changed,
+        restyling Regions made from changed definitions. Used internally
+        '''
+        try:
+            # compiled like init() does, so the cache entry stays valid
+            new = compile_theme(None, self.theme, self.defaults, self.cache)
+        except Exception as e:
+            print(f'Theme not reloaded: {e}')
+            return []
+
+        reloaded = []
+        for k, v in new.items():
+            old = self.config.get(k)
+            if isinstance(v, RegionSpec) and isinstance(old, RegionSpec):
+                if old.copy() == v.copy():
+                    continue
+                if old.style:
+                    old.style.reload(v)
+            elif old == v:
+                continue
+            self.config[k] = v
+            reloaded.append(k)
+        for k in [k for k in self.config if k not in new]:
+            del self.config[k]
+            reloaded.append(k)
+        if 'defaults' in reloaded:
+            Region.DATA = self.config.get('defaults', {})
+        if reloaded:
+            print('Theme reloaded:', ', '.join(reloaded))
+        return reloaded
+
+    def _reload_assets(self, assets):
+        '''
+        Unload changed fonts and images and restyle the Region definitions
+        that use them. Used internally
+        '''
+        for asset in assets:
+            self.images.unload(asset)
+            self.fonts.unload(asset)
+        reloaded = []
+        for k, v in self.config.items():
+            if isinstance(v, RegionSpec) and any(v.values[a] in assets
+                    for a in ('font', 'image', 'pimage')):
+                if v.style:
+                    v.style.reload(v)
+                reloaded.append(k)
+        print('Assets reloaded:', ', '.join(assets))
+        return reloaded
+
+def _mtime(filename):
+    'Get the modification time of a file, or None if it cannot be read'
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ListSource:
+    '''
+    A lazy, read-only list provider for the Region list attribute. Items
+    are created on demand by a getter function, so a list with thousands of
+    entries costs nothing until its rows are actually drawn.
+
+    length: int number of items in the list
+    getter: function(index) that returns the str or bar list for an item
+    layout: optional function(item, area) that returns a laid out bar, a list
+        of (Rect, item) pairs, for bar rows instead of Region._verify_bar()
+    '''
+    def __init__(self, length, getter, layout=None):
+        self.length = length
+        self.getter = getter
+        self.layout = layout
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.getter(i) for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('ListSource index out of range')
+        return self.getter(index)
+
+
+class ListView:
+    '''
+    A filtered, read-only view of another list that only holds the indexes
+    of its visible items, so the underlying items are never copied. It may be
+    assigned to the Region list attribute like any other list.
+
+    items: the underlying list or list provider
+    indexes: a sequence of indexes into items, in display order
+    keys: optional list of lower case search strings for every item in items,
+        used to build the A-Z jump table
+    '''
+    def __init__(self, items, indexes, keys=None):
+        self.items = items
+        self.indexes = indexes
+        self.keys = keys
+        self._letters = None
+        layout = getattr(items, 'layout', None)
+        if layout:
+            self.layout = layout
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.items[i] for i in self.indexes[index]]
+        return self.items[self.indexes[index]]
+
+    def source_index(self, index):
+        'Return the index within the underlying list of the item at index'
+        return self.indexes[index]
+
+    @property
+    def letters(self):
+        '''
+        A dict of {first letter: position} for the first item in the view
+        starting with each letter, built the first time it is used
+        '''
+        if self._letters == None:
+            letters = {}
+            for pos, i in enumerate(self.indexes):
+                key = self.keys[i] if self.keys else list_item_text(self.items[i])
+                c = key[:1].upper()
+                if c not in letters:
+                    letters[c] = pos
+            self._letters = letters
+        return self._letters
+
+    def jump(self, position, step=1):
+        '''
+        Find the first item of the next or previous letter group, allowing
+        quick A-Z jumps through long sorted lists
+
+        position: the current position within the view
+        step: 1 to jump to the next letter, or -1 for the previous one
+        RETURNS: the new position
+        '''
+        starts = sorted(self.letters.values())
+        if not starts:
+            return position
+        k = bisect_right(starts, position) - 1
+        if step < 0 and starts[k] < position:
+            return starts[k]
+        return starts[(k + step) % len(starts)]
+
+
+class ListIndex:
+    '''
+    A type-ahead search index over the items of a Region list. The index is
+    built once, then each call to filter() returns a ListView of the matching
+    items. Short queries are answered straight from the n-gram index, longer
+    ones check only the items in the smallest n-gram or previous result set,
+    so typing one more character stays fast even on very long lists.
+
+    items: a list or list provider to index
+    key: optional function(item) that returns the str to search for an item,
+        which defaults to the item itself or the first str in a bar list
+    '''
+    GRAM = 3
+    CACHE = 64
+    def __init__(self, items, key=None):
+        self.items = items
+        key = key or list_item_text
+        self.keys = keys = [key(items[i]).lower() for i in range(len(items))]
+        self.order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.sorted_keys = [keys[i] for i in self.order]
+
+        grams = {}
+        for i, k in enumerate(keys):
+            for g in {k[j:j+n] for n in range(1, self.GRAM+1)
+                        for j in range(len(k)-n+1)}:
+                grams.setdefault(g, []).append(i)
+        self.grams = grams
+        self.cache = {}
+        self.query = None
+        self.matches = range(len(keys))
+
+    def filter(self, text, prefix=False):
+        '''
+        Filter the indexed items by a search string
+
+        text: str to search for, case insensitive
+        prefix: set True to only match items starting with text, otherwise
+            items containing text anywhere will match
+        RETURNS: a ListView of the matching items in their original order
+        '''
+        q = text.lower()
+        if (q, prefix) not in self.cache:
+            if len(self.cache) > self.CACHE:
+                self.cache.clear()
+            self.cache[(q, prefix)] = ListView(
+                    self.items, self._match(q, prefix), self.keys)
+        view = self.cache[(q, prefix)]
+        self.query, self.matches = (q, prefix), view.indexes
+        return view
+
+    def _match(self, q, prefix):
+        'Return indexes of items that match query q. Used internally'
+        keys = self.keys
+        if not q:
+            return range(len(keys))
+        elif prefix:
+            lo = bisect_left(self.sorted_keys, q)
+            hi = bisect_left(self.sorted_keys, q + '\uffff')
+            return sorted(self.order[lo:hi])
+        elif len(q) <= self.GRAM:
+            return self.grams.get(q, [])
+
+        grams = [q[j:j+self.GRAM] for j in range(len(q)-self.GRAM+1)]
+        candidates = min((self.grams.get(g, []) for g in grams), key=len)
+        if self.query and not self.query[1] and self.query[0] in q:
+            # typing extends the last query, so matches can only shrink
+            if len(self.matches) < len(candidates):
+                candidates = self.matches
+        return [i for i in candidates if q in keys[i]]
+
+
+def list_item_text(item):
+    '''
+    Get the searchable text of a list item
+
+    item: a str or bar list from a Region list
+    RETURNS: the item if it is a str, otherwise the first str in the bar
+    '''
+    if isinstance(item, str):
+        return item
+    for v in item or ():
+        if isinstance(v, str):
+            return v
+    return ''
+
+
 def option_menu(foreground, options, background=None, regions=[]):
     '''
     Display an option menu, handle input, and return selected
@@ -759,9 +1557,27 @@ def option_menu(foreground, options, background=None, regions=[]):
     option    If the dict value is a string the key is displayed, along
               with the 'more' image from ImageManager. If the option is
               selected, option_menu returns the dict value
+
+    Changes are kept in a layer over options, and only written into options
+    on start or when an option is selected, so cancelling leaves them as
+    they were. Changing an option only rebuilds its own row, so the other
+    rows keep their cached layouts
     '''   
-    bars, selectable = make_option_bar(options)
-    copy = deep_update({}, options)
+    return run_screen(option_menu_screen, foreground, options, background,
+            regions)
+
+def option_menu_screen(loop, foreground, options, background=None, regions=[]):
+    '''
+    The screen run by option_menu(), which may be shown with
+    ScreenStack.show() or run inside another screen with "yield from"
+
+    loop: the RunLoop or AsyncRunLoop running the screen
+    RETURNS: the same value as option_menu()
+    '''
+    changes = {}
+    view = Layers(options, changes)
+    icons = option_icons()
+    bars, selectable = make_option_bar(view, icons)
 
     region = Region(foreground)
     region.list = bars
@@ -771,105 +1587,150 @@ def option_menu(foreground, options, background=None, regions=[]):
     background = Region(config['background'])
 
     region.selected = selected = 0
+    inp.drain() # drop input queued before the menu opened
     running = update = 1
     while running:
         running += 1
-        inp.process()
-
-        update = region.update(inp) or update
+        yield
 
-        if inp.pressed:
+        if inp.quit:
+            return ''
+        for r in [region] + regions:
+            update = r.update(inp, True) or update
+        for t, pressed in inp.drain():
             update = True
-            if inp.quit or inp.pressed in ('select', 'B'):
-                deep_update(options, copy)
+            region.handle(pressed)
+            if pressed in ('select', 'B'):
                 return ''
-            elif inp.pressed in ('right', 'A'):
+            elif pressed == 'start':
+                options.update(changes)
+                return ''
+            elif pressed in ('right', 'A'):
                 k = bars[region.selected][0]
-                v = options[k]
+                v = view[k]
                 if isinstance(v, (list, tuple)):
-                    v.append(v.pop(0))
+                    changes[k] = v[1:] + v[:1]
                 elif v == 'checked':
-                    options[k] = 'unchecked'
+                    changes[k] = 'unchecked'
                 elif v == 'unchecked':
-                    options[k] = 'checked'
+                    changes[k] = 'checked'
                 else:
+                    options.update(changes)
                     return v
-                bars, region.selectable = make_option_bar(options)
-                region.list = bars
-            elif inp.pressed in ('left'):
+                bars[region.selected] = option_row(k, changes[k], icons)
+            elif pressed in ('left'):
                 k = bars[region.selected][0]
-                v = options[k]
+                v = view[k]
                 if isinstance(v, (list, tuple)):
-                    i = v.pop(-1)
-                    v.insert(0, i)
-                    bars, region.selectable = make_option_bar(options)
-                    region.list = bars   
+                    changes[k] = v[-1:] + v[:-1]
+                    bars[region.selected] = option_row(k, changes[k], icons)
 
-        if update:
+        if update or inp.update:
             background.draw()
+            for r in regions:
+                r.draw()
             region.draw()
-            screen.present()
+            loop.present()
         update = False
-        sdl2.timer.SDL_Delay(1000//30)
 
-def make_option_bar(d):
+def make_option_bar(d, icons=None):
     '''
     Converts a option dict into a list of bars compatible with the Region
     class.
 
     d: dict that works with the option_menu() function
+    icons: dict of images from option_icons(), loaded by default
     RETURNS: a list of bars compatible with the Region list feature
     '''
-    checked = images.load('checked')
-    unchecked = images.load('unchecked')
-    more = images.load('more')
-    left = images.load('left')
-    right = images.load('right')
-
+    icons = icons or option_icons()
     bars = []
     selectable = []
     for i, (k, v) in enumerate(d.items()):
-        if v == 'checked':
-            bars.append((k, None, 'checked'))
-            selectable.append(i)
-        elif v == 'unchecked':
-            bars.append((k, None, 'unchecked'))
-            selectable.append(i)
-        elif isinstance(v, (list, tuple)):
-            bars.append((k, None, right, v[0], left))
-            selectable.append(i)
-        elif v:
-            bars.append((k, None, more))
+        bar = option_row(k, v, icons)
+        if not isinstance(bar, str):
             selectable.append(i)
-        else:
-            bars.append(k)
+        bars.append(bar)
 
     #selectable = list(range(len(bars))) tested selectable labels
     return bars, selectable
 
-def keyboard(options, kbl, kbu, text=''):
+def option_icons():
+    '''
+    Load the images used by option menu rows, so a menu loads them once
+
+    RETURNS: dict of {name: Image} for 'checked', 'unchecked', 'more',
+        'left' and 'right'
+    '''
+    return {name: images.load(name) for name in
+            ('checked', 'unchecked', 'more', 'left', 'right')}
+
+def option_row(k, v, icons):
+    '''
+    Create the Region list row for one option of an option menu
+
+    k: the option name
+    v: the option value, as described by option_menu()
+    icons: dict of images from option_icons()
+    RETURNS: a bar tuple, or the str k for a label that cannot be selected
+    '''
+    if v == 'checked':
+        return (k, None, 'checked')
+    elif v == 'unchecked':
+        return (k, None, 'unchecked')
+    elif isinstance(v, (list, tuple)):
+        return (k, None, icons['right'], v[0], icons['left'])
+    elif v:
+        return (k, None, icons['more'])
+    return k
+
+KEYBOARDS = {} # prebuilt keyboard layouts, keyed by their key lists
+
+def keyboard_layout(kbl):
+    '''
+    Expand the strings of a keyboard key list into lists of keys, building
+    each layout only once
+
+    kbl: list of strings or bar lists to represent keyboard keys
+    RETURNS: (rows, keys) where rows is the Region list with None values
+        kept for right aligned keys, and keys holds the selectable keys
+        of each row
+    '''
+    spec = tuple(row if isinstance(row, str) else tuple(row) for row in kbl)
+    layout = KEYBOARDS.get(spec)
+    if layout == None:
+        rows = [list(row) for row in spec]
+        layout = KEYBOARDS[spec] = rows, [[k for k in row if k] for row in rows]
+    return layout
+
+def keyboard(options, kbl, kbu, text='', on_change=None, regions=[]):
     '''
     Display an on screen keyboard and allow user to enter/modify
-    a text string
+    a text string. The key caps of each layout are drawn once into a
+    texture, so a keystroke only redraws the selected key and the text
     options: dict of Region attributes for theming
     kbl: list of strings or bar lists to represent keyboard keys
          the final row must be: shift, space, backspace, and then Enter/Done
     kbu: same as kbl but with upper case letters
     test: optional string to edit, or blank by default
+    on_change: optional function(text) called each time the text changes,
+         such as to filter a list with ListIndex.filter() while typing
+    regions: a list of optional Regions to draw behind the keyboard
+    '''
+    return run_screen(keyboard_screen, options, kbl, kbu, text, on_change,
+            regions)
+
+def keyboard_screen(loop, options, kbl, kbu, text='', on_change=None, regions=[]):
     '''
-    def process_kb_list(key_list):
-        '''Expand strings into lists and remove None values
-           (for right aligned buttons) '''
-        n = []
-        for row in key_list:
-            if isinstance(row, str):
-                row = list(row)
-            n.append(row)
-        return n, [[k for k in row if k] for row in n]
+    The screen run by keyboard(), which may be shown with
+    ScreenStack.show() or run inside another screen with "yield from"
 
+    loop: the RunLoop or AsyncRunLoop running the screen
+    RETURNS: the same value as keyboard()
+    '''
+    layouts = keyboard_layout(kbl), keyboard_layout(kbu)
     upper = False
     keyboard = Region(options)
-    keyboard.list, kb = process_kb_list(kbl)
+    keyboard.list, kb = layouts[upper]
     shift, space, backspace, enter, *_ = keyboard.list[-1] 
 
     keyboard.selected = keyboard.selectedx = 1
@@ -880,63 +1741,74 @@ def keyboard(options, kbl, kbu, text=''):
     background.fontsize = keyboard.fontsize
     background.borderx = keyboard.area.x
     #background.align = 'topright'
-    
-    background.text = old_text = text
+    background.text = '' # the single line of text is drawn without wrapping
+
+    old_text = text
+    inp.drain() # drop input queued before the keyboard opened
     running = update = 1
-    while running:
-        running += 1
-        inp.process()
+    try:
+        while running:
+            running += 1
+            yield
 
-        if inp.pressed:
-            update = True
-            if inp.quit or inp.pressed in ('select', 'B'):
+            if inp.quit:
                 return ''
-            if inp.pressed == 'up':
-                keyboard.selected = (keyboard.selected - 1) % len(keyboard.list)
-                keyboard.selectedx = min(max(keyboard.selectedx, 0), len(kb[keyboard.selected])-1)
-            elif inp.pressed == 'down':
-                keyboard.selected = (keyboard.selected + 1) % len(keyboard.list)
-                keyboard.selectedx = min(len(kb[keyboard.selected])-1, max(keyboard.selectedx, 0))
-            elif inp.pressed == 'right':
-                keyboard.selectedx = (keyboard.selectedx+1) % len(kb[keyboard.selected])
-            elif inp.pressed == 'left':
-                keyboard.selectedx = (keyboard.selectedx-1) % len(kb[keyboard.selected])
-            elif inp.pressed == 'start':
-                return text.replace('_', ' ')
-            elif inp.pressed in ('X', 'Y'):
-                    keyboard.list, kb = process_kb_list(kbl if upper else kbu)
-                    upper = not upper
-            elif inp.pressed == 'L':
-                text = text[:-1]
-            elif inp.pressed == 'R':
-                text += '_'
-            elif inp.pressed == 'A':
-                key = kb[keyboard.selected][keyboard.selectedx]
-                if len(key) == 1:
-                    text += key
-                elif key == space:
-                    text += '_'
-                elif key == backspace:
-                    text = text[:-1]
-                elif key == shift:
-                    keyboard.list, kb = process_kb_list(kbl if upper else kbu)
-                    upper = not upper
-                elif key == 'DONE':
+            for r in regions:
+                update = r.update(inp, True) or update
+            for t, pressed in inp.drain():
+                update = True
+                if pressed in ('select', 'B'):
+                    return ''
+                if pressed == 'up':
+                    keyboard.selected = (keyboard.selected - 1) % len(keyboard.list)
+                    keyboard.selectedx = min(max(keyboard.selectedx, 0), len(kb[keyboard.selected])-1)
+                elif pressed == 'down':
+                    keyboard.selected = (keyboard.selected + 1) % len(keyboard.list)
+                    keyboard.selectedx = min(len(kb[keyboard.selected])-1, max(keyboard.selectedx, 0))
+                elif pressed == 'right':
+                    keyboard.selectedx = (keyboard.selectedx+1) % len(kb[keyboard.selected])
+                elif pressed == 'left':
+                    keyboard.selectedx = (keyboard.selectedx-1) % len(kb[keyboard.selected])
+                elif pressed == 'start':
                     return text.replace('_', ' ')
+                elif pressed in ('X', 'Y'):
+                        upper = not upper
+                        keyboard.list, kb = layouts[upper]
+                elif pressed == 'L':
+                    text = text[:-1]
+                elif pressed == 'R':
+                    text += '_'
+                elif pressed == 'A':
+                    key = kb[keyboard.selected][keyboard.selectedx]
+                    if len(key) == 1:
+                        text += key
+                    elif key == space:
+                        text += '_'
+                    elif key == backspace:
+                        text = text[:-1]
+                    elif key == shift:
+                        upper = not upper
+                        keyboard.list, kb = layouts[upper]
+                    elif key == 'DONE':
+                        return text.replace('_', ' ')
 
             if text != old_text:
-                background.text = text
                 if fonts.width(text) > keyboard.area.width:
                     background.align = 'topright'
                 else: background.align = 'topleft'
+                if on_change:
+                    on_change(text.replace('_', ' '))
 
-        if update:
-            background.draw()
-            keyboard.draw()
-            screen.present()
-            old_text = text
-        update = False
-        sdl2.timer.SDL_Delay(1000//30)
+            if update or inp.update:
+                background.draw(text=text)
+                for r in regions:
+                    r.draw()
+                keyboard.draw_cached(upper)
+                loop.present()
+                old_text = text
+            update = False
+    finally:
+        keyboard.clear_cached()
 
 
 KEY_MAP = {
@@ -965,6 +1837,10 @@ AXIS_MAP = {
     (0,-1): 'left',
     (0,1): 'right' }
 
+class ReplayFinished(Exception):
+    'Raised by InputHandler.process() when an input replay has ended'
+
+
 class InputHandler():
     '''
     Reads the SDL2 event que and generates a simple sets of input
@@ -982,93 +1858,1149 @@ class InputHandler():
         will be none if there are no new inputs, or one of several
         string values: 'up', 'down', 'left', 'right', 'A', 'B', 'X',
                        'Y', 'L', 'R', 'start', 'select'
-
+        If several inputs arrive in one frame, pressed is the last one
+    tasks: the TaskRunner Tasks that finished or changed the Regions bound
+        to them during the last process() call, so a loop only needs to
+        redraw when it is not empty
+    events: a queue of every (time, input) pair, including repeats, in
+        the order they happened. time is in SDL ticks (ms). Read it with
+        drain() to handle inputs that arrive faster than frames are drawn
+
+    Repeats are timed in ms from the SDL event timestamps, so they keep the
+    same speed when frames run slow. Set REPEAT_ACCEL below 1 to shorten
+    each repeat interval by that factor while an input is held, down to
+    REPEAT_MIN.
+
+    Unless created with filter=False, SDL stops queuing the IGNORE_EVENTS
+    types, and controller axis motion is coalesced: each frame the queued
+    axis events are flushed together and the open controller's AXES are
+    read once, so analog stick noise never reaches python. Raw joystick
+    events, which SDL needs to create controller events, are flushed from
+    the queue without being read.
     '''
-    REPEAT_RATE = 5
-    REPEAT_DELAY = 10
+    REPEAT_RATE = 200 # ms between repeats
+    REPEAT_DELAY = 530 # ms before the first repeat
+    REPEAT_ACCEL = 1 # factor applied to REPEAT_RATE after each repeat
+    REPEAT_MIN = 40 # shortest ms between accelerated repeats
+    REPEAT_BURST = 4 # most repeats queued by one process() after a stall
+    EVENTS = 64 # most queued events kept when they are not drained
     CAN_REPEAT =  ('up', 'down', 'right', 'left')
     AXIS_MOD = 2 ** 15 * 1.2
-    def __init__(self):
-        sdl2.ext.common.init(controller=True)
-        try:
-            self.joy = sdl2.SDL_GameControllerOpen(0)
-        except:
-            self.joy = None
+    IGNORE_EVENTS = (sdl2.SDL_MOUSEMOTION, sdl2.SDL_MOUSEBUTTONDOWN,
+            sdl2.SDL_MOUSEBUTTONUP, sdl2.SDL_MOUSEWHEEL, sdl2.SDL_FINGERDOWN,
+            sdl2.SDL_FINGERUP, sdl2.SDL_FINGERMOTION, sdl2.SDL_DOLLARGESTURE,
+            sdl2.SDL_MULTIGESTURE, sdl2.SDL_TEXTEDITING, sdl2.SDL_TEXTINPUT,
+            sdl2.SDL_CONTROLLERTOUCHPADDOWN, sdl2.SDL_CONTROLLERTOUCHPADMOTION,
+            sdl2.SDL_CONTROLLERTOUCHPADUP, sdl2.SDL_CONTROLLERSENSORUPDATE,
+            sdl2.SDL_SENSORUPDATE)
+    FLUSH_EVENTS = sdl2.SDL_JOYAXISMOTION, sdl2.SDL_JOYBUTTONUP
+    AXES = sorted({a for a, v in AXIS_MAP})
+    EVENT_BUFFER = 32 # events read from SDL with each SDL_PeepEvents call
+    def __init__(self, controller=True, filter=True):
+        self.joy = None
+        if controller:
+            self.open_controller()
         self.quit = False
         self.buttons = {}
         self.keys = {}
         self.axes = {}
+        self.coalesce = False
+        self.buffer = (sdl2.SDL_Event * self.EVENT_BUFFER)()
+        self.handlers = {
+            sdl2.SDL_QUIT: self._on_quit,
+            sdl2.SDL_CONTROLLERDEVICEADDED: self._on_device_added,
+            sdl2.SDL_KEYDOWN: self._on_key_down,
+            sdl2.SDL_KEYUP: self._on_key_up,
+            sdl2.SDL_CONTROLLERBUTTONDOWN: self._on_button_down,
+            sdl2.SDL_CONTROLLERBUTTONUP: self._on_button_up,
+            sdl2.SDL_CONTROLLERAXISMOTION: self._on_axis,
+            sdl2.SDL_WINDOWEVENT: self._on_window}
+        if filter:
+            self.filter_events()
         self.last_press = None
-        self.held_for = 0
+        self.next_repeat = 0
+        self.repeat_rate = self.REPEAT_RATE
+        self.events = deque(maxlen=self.EVENTS)
+        self.frame_events = [] # events queued by the last process(), for record()
         self.selected = 0
+        self.tasks = []
+        self.combos = {}
+        self.frame = 0
+        self.recording = None
+        self.replaying = None
+
+    def open_controller(self):
+        '''
+        Initialize the game controller subsystem and open the first
+        controller. InputHandler(controller=False) leaves this for later,
+        such as a deferred startup task, so it does not delay the first frame.
+        '''
+        sdl2.ext.common.init(controller=True)
+        try:
+            self.joy = sdl2.SDL_GameControllerOpen(0)
+        except:
+            self.joy = None
+
+    def filter_events(self, ignore=None, coalesce=True):
+        '''
+        Keep unused events out of the SDL event queue. Called by __init__
+        unless filter=False is passed
+
+        ignore: list of SDL event types for SDL to stop queuing,
+            IGNORE_EVENTS by default
+        coalesce: replace the axis motion events of each frame with one
+            read of the open controller's axes, or False to handle every
+            axis event
+        '''
+        for t in self.IGNORE_EVENTS if ignore == None else ignore:
+            sdl2.SDL_EventState(t, sdl2.SDL_IGNORE)
+        self.coalesce = coalesce
+
+    def bind(self, combo, func):
+        '''
+        Call a function when a combination of inputs is held down together.
+        The input that completes the combination is not reported as pressed.
+
+        combo: a list of input strings, such as ('L', 'R', 'X')
+        func: function to call, with no arguments
+        '''
+        self.combos[frozenset(combo)] = func
+
+    def drain(self):
+        '''
+        Return every queued (time, input) event and empty the queue. Time is
+        the SDL tick (ms) the input was pressed or repeated at.
+        '''
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def _press(self, name, held_map, key, time):
+        '''
+        Report a new input and start timing its repeats. Used internally
+
+        name: input string, such as 'up' or 'A'
+        held_map: the keys, buttons or axes dict that shows if it is held
+        key: the key, button or axis of the input in held_map
+        time: SDL timestamp of the event, in ms
+        '''
+        self.pressed = name
+        self.events.append((time, name))
+        self.frame_events.append((time, name))
+        self.last_press = held_map, key, name
+        self.next_repeat = time + self.REPEAT_DELAY
+        self.repeat_rate = self.REPEAT_RATE
+
+    def held_inputs(self):
+        'Return a set of the input strings that are currently held down'
+        held = {KEY_MAP[k] for k, v in self.keys.items() if v and k in KEY_MAP}
+        held.update(BUTTON_MAP[b] for b, v in self.buttons.items()
+                if v and b in BUTTON_MAP)
+        held.update(AXIS_MAP[(a, v)] for a, v in self.axes.items()
+                if (a, v) in AXIS_MAP)
+        return held
+
+    def record(self, filename):
+        '''
+        Start recording the input of every process() call, to save into a
+        file for replay() later. The recording is saved by stop_recording(),
+        or when the program exits.
+
+        filename: file to save the recording into
+        '''
+        self.recording = []
+        self.record_file = filename
+        self.record_start = sdl2.SDL_GetTicks()
+        self.frame = 0
+        atexit.register(self.stop_recording)
+
+    def stop_recording(self):
+        'Stop recording and save the recorded input as JSON'
+        if self.recording == None:
+            return
+        with open(self.record_file, 'w') as out:
+            json.dump({'version': 2, 'frames': self.frame,
+                       'events': self.recording}, out)
+        print(f'Saved {len(self.recording)} input events into {self.record_file}')
+        self.recording = None
+
+    def replay(self, filename):
+        '''
+        Replay input recorded by record(). Each process() call reads the
+        input recorded for the same frame instead of real input, without
+        waiting, and queues every input and repeat recorded in that frame
+        for drain(), so a recorded session repeats exactly. Once every
+        recorded frame has been replayed process() raises ReplayFinished.
+
+        filename: file saved by a previous recording
+        '''
+        with open(filename) as inp:
+            data = json.load(inp)
+        self.replaying = {e[0]: e for e in data['events']}
+        self.replay_frames = data['frames']
+        self.frame = 0
+
+    def _replay_frame(self):
+        'Set the input of this frame from the replay. Used internally'
+        self.frame += 1
+        if self.frame > self.replay_frames:
+            self.replaying = None
+            raise ReplayFinished(f'replayed {self.replay_frames} frames')
+        frame, ms, self.pressed, quit, update, *events = self.replaying.get(
+                self.frame, (self.frame, 0, None, False, False, []))
+        self.quit = bool(quit)
+        self.update = bool(update)
+        if events: # version 2 recordings keep every event of the frame
+            self.events.extend((t, name) for t, name in events[0])
+        elif self.pressed:
+            self.events.append((ms, self.pressed))
 
     def process(self):
         '''
         Polls the sdl2 event handler for events and updates the quit, update
         and pressed variables.
         '''
-        events = sdl2.ext.get_events()
+        sdl2.SDL_PumpEvents()
+        sdl2.SDL_FlushEvents(*self.FLUSH_EVENTS)
+        if self.tasks:
+            self.tasks = []
+        if self.replaying != None:
+            # replayed input replaces real input, but tasks still report
+            sdl2.SDL_FlushEvents(sdl2.SDL_FIRSTEVENT, sdl2.SDL_USEREVENT - 1)
+            self._read_events()
+            return self._replay_frame()
         self.pressed = None
         self.update = False
-        for e in events:
-            if e.type == sdl2.SDL_QUIT:
-                self.quit = True
-            elif e.type == sdl2.SDL_CONTROLLERDEVICEADDED:
-                sdl2.ext.common.init(controller=True)
-                self.joy = sdl2.SDL_GameControllerOpen(0)
-                print('Controller connected')
-            
-            # KEYBOARD
-            elif e.type == sdl2.SDL_KEYDOWN:
-                key = e.key.keysym.sym
-                if key == sdl2.SDLK_ESCAPE:
-                    self.quit = True
-
-                if not self.keys.get(key):
-                    self.keys[key] = True
-                    if key in KEY_MAP:
-                        self.pressed = KEY_MAP[key]
-                        self.last_press = self.keys, key, self.pressed
-                        self.held_for = -self.REPEAT_DELAY
-            elif e.type == sdl2.SDL_KEYUP:
-                key = e.key.keysym.sym
-                self.keys[key] = False
-
-            # BUTTONS
-            elif e.type == sdl2.SDL_CONTROLLERBUTTONDOWN:
-                butt = e.cbutton.button
-                self.buttons[butt] = True
-                if butt in BUTTON_MAP:
-                    self.pressed = BUTTON_MAP[butt]
-                    self.last_press = self.buttons, butt, self.pressed
-                    self.held_for = -self.REPEAT_DELAY
-            elif e.type == sdl2.SDL_CONTROLLERBUTTONUP:
-                butt = e.cbutton.button
-                self.buttons[butt] = False
-
-            elif e.type == sdl2.SDL_CONTROLLERAXISMOTION:
-                a = e.caxis.axis
-                v = round(e.caxis.value / self.AXIS_MOD)
-                if (a,v) in AXIS_MAP:
-                    if v and self.axes.get(a) != v:
-                        self.pressed = AXIS_MAP[(a,v)]
-                        self.last_press = self.axes, a, self.pressed 
-                        self.held_for = -self.REPEAT_DELAY
-                self.axes[a] = v
-            elif e.type == sdl2.SDL_WINDOWEVENT:
-                if e.window.event == sdl2.SDL_WINDOWEVENT_EXPOSED:
+        self.frame_events = []
+        if self.coalesce and self.joy and sdl2.SDL_HasEvent(
+                sdl2.SDL_CONTROLLERAXISMOTION):
+            sdl2.SDL_FlushEvent(sdl2.SDL_CONTROLLERAXISMOTION)
+            time = sdl2.SDL_GetTicks()
+            for a in self.AXES:
+                self._set_axis(a, round(sdl2.SDL_GameControllerGetAxis(
+                        self.joy, a) / self.AXIS_MOD), time)
+        self._read_events()
+
+        # HANDLE COMBINATIONS
+        if self.pressed and self.combos:
+            held = self.held_inputs()
+            for combo, func in self.combos.items():
+                if self.pressed in combo and combo <= held:
+                    if self.events and self.events[-1][1] == self.pressed:
+                        self.events.pop()
+                        self.frame_events.pop()
+                    self.pressed = None
+                    self.last_press = None
                     self.update = True
+                    func()
+                    break
             
         # HANDLE KEY REPEATS
         if self.last_press:
-            pressed = None
             m, k, b = self.last_press
-            
-            if b in self.CAN_REPEAT and m.get(k):
-                self.held_for += 1
-                if self.held_for > self.REPEAT_RATE:
-                    self.held_for = 0
+            now = sdl2.SDL_GetTicks()
+            if b in self.CAN_REPEAT and m.get(k) and self.next_repeat <= now:
+                for _ in range(self.REPEAT_BURST):
+                    self.events.append((self.next_repeat, b))
+                    self.frame_events.append((self.next_repeat, b))
                     self.pressed = b
+                    self.repeat_rate = max(self.REPEAT_MIN,
+                            self.repeat_rate * self.REPEAT_ACCEL)
+                    self.next_repeat += int(self.repeat_rate)
+                    if self.next_repeat > now:
+                        break
+                else: # too far behind, continue from now
+                    self.next_repeat = now + int(self.repeat_rate)
+
+        if self.recording != None:
+            self.frame += 1
+            if self.pressed or self.quit or self.update:
+                start = self.record_start
+                self.recording.append((self.frame,
+                        sdl2.SDL_GetTicks() - start,
+                        self.pressed, self.quit, self.update,
+                        [(t - start, name) for t, name in self.frame_events]))
+
+    def _read_events(self):
+        'Read the SDL event queue and pass each event to its handler. Used internally'
+        handlers = self.handlers
+        buffer, size = self.buffer, len(self.buffer)
+        count = size
+        while count == size:
+            count = sdl2.SDL_PeepEvents(buffer, size, sdl2.SDL_GETEVENT,
+                    sdl2.SDL_FIRSTEVENT, sdl2.SDL_LASTEVENT)
+            for i in range(count):
+                e = buffer[i]
+                handler = handlers.get(e.type)
+                if handler:
+                    handler(e)
+
+    def _on_quit(self, e):
+        self.quit = True
+
+    def _on_device_added(self, e):
+        sdl2.ext.common.init(controller=True)
+        self.joy = sdl2.SDL_GameControllerOpen(0)
+        print('Controller connected')
+
+    def _on_key_down(self, e):
+        key = e.key.keysym.sym
+        if key == sdl2.SDLK_ESCAPE:
+            self.quit = True
+        if not self.keys.get(key):
+            self.keys[key] = True
+            if key in KEY_MAP:
+                self._press(KEY_MAP[key], self.keys, key, e.key.timestamp)
+
+    def _on_key_up(self, e):
+        self.keys[e.key.keysym.sym] = False
+
+    def _on_button_down(self, e):
+        butt = e.cbutton.button
+        self.buttons[butt] = True
+        if butt in BUTTON_MAP:
+            self._press(BUTTON_MAP[butt], self.buttons, butt,
+                    e.cbutton.timestamp)
+
+    def _on_button_up(self, e):
+        self.buttons[e.cbutton.button] = False
+
+    def _on_axis(self, e):
+        self._set_axis(e.caxis.axis, round(e.caxis.value / self.AXIS_MOD),
+                e.caxis.timestamp)
+
+    def _set_axis(self, a, v, time):
+        if (a,v) in AXIS_MAP:
+            if v and self.axes.get(a) != v:
+                self._press(AXIS_MAP[(a,v)], self.axes, a, time)
+        self.axes[a] = v
+
+    def _on_window(self, e):
+        if e.window.event == sdl2.SDL_WINDOWEVENT_EXPOSED:
+            self.update = True
+
+    @property
+    def held(self):
+        'True while a repeatable input is held down and may generate repeats'
+        if self.last_press:
+            m, k, b = self.last_press
+            return b in self.CAN_REPEAT and bool(m.get(k))
+        return False
+
+
+class RunLoop:
+    '''
+    Paces a GUI loop, replacing the inp.process() and SDL_Delay() calls of a
+    hand written loop. While the screen is idle the loop blocks until input
+    arrives or a wake() deadline passes, so an unchanged screen does not wake
+    the program every frame. While active it only sleeps what is left of each
+    frame, and it drops missed frames instead of trying to catch up when
+    frames run slow.
+
+        loop = RunLoop()
+        while running:
+            loop.tick()
+            ...handle inp.pressed and update Regions...
+            if update:
+                ...draw Regions...
+                loop.present()
+
+    fps: target frames per second while active, RunLoop.FPS by default
+    idle: longest time in ms to block while idle, so the loop still returns
+        now and then when nothing happens
+    vsync: set True if the renderer presents with vsync so frames are paced
+        by present() rather than by sleeping, RunLoop.VSYNC by default
+    inp: InputHandler to process, or the global inp by default
+    '''
+    FPS = 30
+    VSYNC = False
+    WATCHER = None # ThemeWatcher polled by tick() in development mode
+    IDLE_FRAMES = 2 # frames without drawing before the loop goes idle
+    def __init__(self, fps=None, idle=1000, vsync=None, inp=None):
+        self.frame_time = 1000 / (fps or RunLoop.FPS)
+        self.idle = idle
+        self.vsync = RunLoop.VSYNC if vsync == None else vsync
+        self.inp = inp
+        self.deadline = None
+        self.next_frame = sdl2.SDL_GetTicks()
+        self.quiet = 0
+        self.frames = 0
+        self.skipped = 0
+
+    @property
+    def is_idle(self):
+        'True if the next tick() will block until input or a deadline'
+        inp_ = self.inp or inp
+        return self.quiet >= self.IDLE_FRAMES and not inp_.held and (
+                not startup.tasks) and not sounds.pending and (
+                self.deadline == None or self.deadline > sdl2.SDL_GetTicks())
+
+    def wake(self, ms=0):
+        '''
+        Make the loop run again within ms milliseconds even without input,
+        such as for autoscrolling text or animations. Call it every frame
+        to keep the loop active.
+        '''
+        t = sdl2.SDL_GetTicks() + ms
+        if self.deadline == None or t < self.deadline:
+            self.deadline = t
+
+    def tick(self):
+        '''
+        Wait for the next frame, or for input while idle, and then process
+        input. Call it once at the top of each pass through a GUI loop.
+        '''
+        inp_ = self.inp or inp
+        now = sdl2.SDL_GetTicks()
+        if inp_.replaying != None:
+            pass # replays run frame locked, as fast as possible
+        elif self.is_idle:
+            wait = self.idle if self.deadline == None else self.deadline - now
+            sdl2.SDL_WaitEventTimeout(None, max(0, int(wait)))
+            now = self.next_frame = sdl2.SDL_GetTicks()
+        elif not self.vsync:
+            delay = self.next_frame - now
+            if delay > 0:
+                sdl2.SDL_Delay(int(delay))
+                now = sdl2.SDL_GetTicks()
+            elif delay <= -self.frame_time:
+                # drop the missed frames instead of rushing to catch up
+                self.skipped += int(-delay // self.frame_time)
+                self.next_frame = now
+        self._advance(now)
+
+    def _advance(self, now):
+        '''
+        Start the frame after waiting for it, processing input and running
+        a deferred startup task and the sound calls queued while audio was
+        opening. Used internally
+
+        now: SDL_GetTicks() time the wait ended
+        '''
+        inp_ = self.inp or inp
+        self.next_frame += self.frame_time
+        if self.deadline != None and now >= self.deadline:
+            self.deadline = None
+
+        inp_.process()
+        if RunLoop.WATCHER and RunLoop.WATCHER.poll():
+            inp_.update = True
+        self.quiet += 1
+        if inp_.pressed or inp_.update or inp_.quit:
+            self.quiet = 0
+        if startup.tasks:
+            startup.run_next()
+        sounds.poll()
+
+    def present(self, renderer=None):
+        '''
+        Present the drawn frame and keep the loop active for a few frames
+
+        renderer: sdl2.ext.Renderer to present, or the global screen by default
+        '''
+        (renderer or screen).present()
+        self.quiet = 0
+        self.frames += 1
+        if startup.first_frame == None:
+            startup.frame()
+
+
+class AsyncRunLoop(RunLoop):
+    '''
+    A RunLoop for GUI loops running as asyncio coroutines. Its tick() is
+    awaited, and waits with asyncio.sleep() instead of blocking in SDL, so
+    background coroutines on the same event loop run while the screen
+    waits for its next frame or for input. SDL only waits on the thread
+    running the event loop, which must be the main thread.
+
+        loop = AsyncRunLoop()
+        while running:
+            await loop.tick()
+            ...handle inp.pressed and update Regions...
+            if update:
+                ...draw Regions...
+                loop.present()
+
+    Takes the same arguments as RunLoop
+    '''
+    POLL = 15 # ms between checks for input while idle
+    driver = None # task running the screens of a ScreenStack
+
+    async def tick(self):
+        '''
+        Wait for the next frame, or for input while idle, letting other
+        coroutines run meanwhile, and then process input. While a
+        ScreenStack is showing screens on this loop, other coroutines wait
+        here until the last screen returns, so only the top screen ticks
+        '''
+        driver = self.driver
+        while driver != None and driver is not asyncio.current_task():
+            await asyncio.wait((driver,))
+            driver = self.driver
+        inp_ = self.inp or inp
+        now = sdl2.SDL_GetTicks()
+        if inp_.replaying != None:
+            await asyncio.sleep(0) # replays run frame locked
+        elif self.is_idle:
+            timeout = now + (self.idle if self.deadline == None
+                    else self.deadline - now)
+            while now < timeout:
+                sdl2.SDL_PumpEvents()
+                if sdl2.SDL_HasEvents(sdl2.SDL_FIRSTEVENT, sdl2.SDL_LASTEVENT):
+                    break
+                await asyncio.sleep(min(self.POLL, timeout - now) / 1000)
+                now = sdl2.SDL_GetTicks()
+                if self.deadline != None:
+                    timeout = min(timeout, self.deadline)
+            now = self.next_frame = sdl2.SDL_GetTicks()
+        elif not self.vsync:
+            delay = self.next_frame - now
+            if delay > 0:
+                await asyncio.sleep(delay / 1000)
+                now = sdl2.SDL_GetTicks()
+            else:
+                if delay <= -self.frame_time:
+                    self.skipped += int(-delay // self.frame_time)
+                    self.next_frame = now
+                await asyncio.sleep(0) # let other coroutines run every frame
+        else:
+            await asyncio.sleep(0)
+        self._advance(now)
+
+
+class ScreenStack:
+    '''
+    Runs screens on an asyncio event loop, so downloads, file scans and
+    other coroutines keep running while a menu or keyboard is open. A
+    screen is a generator function taking (loop, *args), which yields once
+    before every frame where a hand written loop would call loop.tick(),
+    and returns its result. Screens run inside other screens with
+    "yield from", or with "await stack.show()" from coroutines.
+
+    Only the top screen runs, from a single task that ticks the loop once
+    per frame. The screens under it stay suspended until it returns, and
+    are then resumed with inp.update set so they redraw. Coroutines that
+    await loop.tick() themselves wait until every screen has returned.
+
+        async def main(stack):
+            stack.spawn(scan_files())
+            choice = await stack.show(option_menu_screen, region, options)
+
+        ScreenStack().run(main)
+
+    The same screens run without asyncio through run_screen(), which is
+    how option_menu() and keyboard() block until they return.
+
+    fps: target frames per second while active, RunLoop.FPS by default
+    idle: longest time in ms to wait while idle
+    inp: InputHandler to process, or the global inp by default
+    '''
+    def __init__(self, fps=None, idle=1000, inp=None):
+        self.loop = AsyncRunLoop(fps, idle, inp=inp)
+        self.screens = []
+        self.tasks = set()
+
+    @property
+    def top(self):
+        'The screen drawing and receiving input, or None'
+        return self.screens[-1][0] if self.screens else None
+
+    async def show(self, screen, *args, **kwargs):
+        '''
+        Push a screen onto the stack and wait until it returns. It covers
+        the screen that was on top, which is suspended until then
+
+        screen: generator function taking (loop, *args, **kwargs)
+        RETURNS: the value returned by the screen
+        '''
+        gen = screen(self.loop, *args, **kwargs)
+        entry = gen, asyncio.get_running_loop().create_future()
+        self.screens.append(entry)
+        if self.loop.driver == None:
+            self.loop.driver = asyncio.get_running_loop().create_task(
+                    self._drive())
+        try:
+            return await entry[1]
+        finally:
+            if entry in self.screens: # cancelled before it returned
+                self.screens.remove(entry)
+                gen.close()
+
+    async def _drive(self):
+        '''
+        Run the top screen once per frame until the stack is empty, passing
+        each screen's result or error to its show() call. Used internally
+        '''
+        inp_ = self.loop.inp or inp
+        try:
+            while self.screens:
+                entry = gen, done = self.screens[-1]
+                try:
+                    next(gen)
+                    uncovered = False
+                except BaseException as e:
+                    self.screens.remove(entry)
+                    if not done.done():
+                        if isinstance(e, StopIteration):
+                            done.set_result(e.value)
+                        else:
+                            done.set_exception(e)
+                    if not self.screens:
+                        break
+                    uncovered = True
+                await self.loop.tick()
+                if uncovered:
+                    inp_.update = True # the screen below redraws
+        except BaseException as e:
+            # the loop failed, such as when a replay finished
+            for gen, done in self.screens:
+                if done.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    done.cancel()
+                else:
+                    done.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.loop.driver = None
+
+    def spawn(self, coro):
+        '''
+        Run a coroutine in the background while screens keep drawing. The
+        loop is woken when it finishes so screens can show its result
+
+        coro: the coroutine to run
+        RETURNS: its asyncio.Task
+        '''
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        'Forget a finished task and wake the loop. Used internally'
+        self.tasks.discard(task)
+        self.loop.wake()
+
+    def run(self, main, *args):
+        '''
+        Run a coroutine function on a new asyncio event loop in this thread,
+        cancelling the tasks it spawned when it returns
+
+        main: coroutine function called as main(stack, *args)
+        RETURNS: the value returned by main
+        '''
+        async def run():
+            try:
+                return await main(self, *args)
+            finally:
+                for task in list(self.tasks):
+                    task.cancel()
+        return asyncio.run(run())
+
+
+class TaskCancelled(Exception):
+    'Raised by Task.report() inside a task that has been cancelled'
+
+
+class Task:
+    '''
+    A function running in the background on a TaskRunner. Its state is
+    only updated on the main thread, by InputHandler.process(), so the GUI
+    may read it at any time.
+
+    name: str describing the task
+    state: 'pending', 'running', 'done', 'failed' or 'cancelled'
+    progress: float from 0 to 1 last reported by the task, or None
+    message: str last reported by the task, or None
+    result: the value the function returned once the task is done
+    error: the exception the function raised once the task failed
+    '''
+    def __init__(self, runner, name, on_progress=None, on_done=None):
+        self.runner = runner
+        self.id = TaskRunner.next_id
+        self.name = name
+        self.state = 'pending'
+        self.progress = self.message = None
+        self.result = self.error = None
+        self.future = None
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.bindings = []
+        self._cancel = threading.Event()
+        self._reported = None
+        self._posted = False
+
+    def __repr__(self):
+        return f'<Task {self.name} {self.state}>'
+
+    @property
+    def cancelled(self):
+        'True once cancel() was called, for tasks to check while they work'
+        return self._cancel.is_set()
+
+    @property
+    def finished(self):
+        'True once the task is done, failed or cancelled'
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def report(self, progress=None, message=None):
+        '''
+        Report progress from inside a thread task. Reports are coalesced, so
+        only the latest one is seen if several arrive within a frame.
+        Raises TaskCancelled once the task has been cancelled, which ends
+        the task unless it is caught
+
+        progress: float from 0 to 1, or None if unknown
+        message: optional str describing the current step
+        '''
+        if self._cancel.is_set():
+            raise TaskCancelled(self.name)
+        self._reported = progress, message
+        if not self._posted:
+            self._posted = True
+            self.runner._post(self, TaskRunner.PROGRESS)
+
+    def cancel(self):
+        '''
+        Cancel the task. A pending task never starts, and a running thread
+        task stops at its next report(). Process tasks can not be stopped
+        once started, so their result is discarded.
+        '''
+        self._cancel.set()
+        if self.future != None:
+            self.future.cancel()
+
+    def bind(self, region, text='{name} {percent}%', bar=None):
+        '''
+        Show the progress of this task in a Region. The Region is only
+        changed when what it shows changes, and only then is the task listed
+        in inp.tasks, so a loop redraws once per visible step rather than
+        once for every report
+
+        region: the Region to update
+        text: str formatted with name, percent, progress, message and state
+            to set as the Region's text
+        bar: optional bar list to set as the Region's bar instead, with each
+            str item formatted like text
+        '''
+        self.bindings.append([region, text, bar, None])
+        self._update_bindings()
+
+    def _update_bindings(self):
+        '''
+        Update the bound Regions. Used internally
+
+        RETURNS: True if any bound Region changed
+        '''
+        changed = False
+        progress = self.progress
+        values = dict(name=self.name, progress=progress, state=self.state,
+                percent=0 if progress == None else int(progress * 100),
+                message=self.message or '')
+        for binding in self.bindings:
+            region, text, bar, shown = binding
+            if bar == None:
+                text = text.format(**values)
+            else:
+                text = [v.format(**values) if isinstance(v, str) else v
+                        for v in bar]
+            if text != shown:
+                binding[3] = text
+                if bar == None:
+                    region.text = text
+                else:
+                    region.bar = text
+                changed = True
+        return changed
+
+
+class TaskRunner:
+    '''
+    Runs long file operations, downloads and other work in the background
+    on a thread pool, or on a process pool for CPU heavy work, so the render
+    loop never blocks. Tasks report progress and completion back to the
+    main thread as SDL user events, which InputHandler.process() handles,
+    listing the Tasks with news in inp.tasks and calling their callbacks.
+
+        runner = TaskRunner(inp)
+        task = runner.run(install, zip_file, name='Installing')
+        task.bind(status)
+        while running:
+            loop.tick()
+            if inp.tasks:
+                update = True
+
+    Every TaskRunner shares one SDL event type and one handler, which finds
+    the Task of each event in TaskRunner.TASKS by its id, so several runners
+    may report through the same InputHandler.
+
+    inp: the InputHandler that handles the task events
+    threads: the most thread tasks running at once
+    processes: the most process tasks running at once, or None for one
+        per CPU. The process pool is started by the first process task
+    '''
+    EVENT = None # SDL user event type, registered by the first TaskRunner
+    PROGRESS = 0; DONE = 1 # event codes
+    TASKS = {} # unfinished Tasks of every TaskRunner, by id
+    next_id = 1 # id of the next Task made by any TaskRunner
+    def __init__(self, inp, threads=4, processes=None):
+        if TaskRunner.EVENT == None:
+            event = sdl2.SDL_RegisterEvents(1)
+            if event == 0xFFFFFFFF:
+                raise RuntimeError('no SDL user events left for TaskRunner')
+            TaskRunner.EVENT = event
+        self.threads = ThreadPoolExecutor(threads, thread_name_prefix='task')
+        self.processes = None
+        self.max_processes = processes
+        self.tasks = {}
+        self.inp = inp
+        inp.handlers[TaskRunner.EVENT] = TaskRunner._on_event
+
+    def run(self, func, *args, name=None, on_progress=None, on_done=None,
+            **kwargs):
+        '''
+        Run a function on the thread pool. It is called as
+        func(task, *args, **kwargs) and may call task.report() to report
+        progress. It must not call SDL or draw anything
+
+        func: the function to run
+        name: str describing the task, func's name by default
+        on_progress: optional function(task) called on the main thread
+            after the task reports progress
+        on_done: optional function(task) called on the main thread once
+            the task is done, failed or cancelled
+        RETURNS: the Task
+        '''
+        task = self._task(name or func.__name__, on_progress, on_done)
+        task.future = self.threads.submit(self._work, task, func, args, kwargs)
+        task.future.add_done_callback(lambda f: self._post(task, self.DONE))
+        return task
+
+    def run_process(self, func, *args, name=None, on_done=None, **kwargs):
+        '''
+        Run a function on the process pool, for CPU heavy work that would
+        slow the GUI down even on a thread. It is called as
+        func(*args, **kwargs), so func and its arguments must be picklable,
+        and it can not report progress
+
+        func: the function to run, defined at the top level of a module
+        name: str describing the task, func's name by default
+        on_done: optional function(task) called on the main thread once
+            the task is done, failed or cancelled
+        RETURNS: the Task
+        '''
+        if self.processes == None:
+            self.processes = ProcessPoolExecutor(self.max_processes)
+        task = self._task(name or func.__name__, None, on_done)
+        task.state = 'running'
+        task.future = self.processes.submit(func, *args, **kwargs)
+        task.future.add_done_callback(lambda f: self._post(task, self.DONE))
+        return task
+
+    def _task(self, name, on_progress, on_done):
+        'Create and remember a new Task. Used internally'
+        task = Task(self, name, on_progress, on_done)
+        self.tasks[task.id] = TaskRunner.TASKS[task.id] = task
+        TaskRunner.next_id += 1
+        return task
+
+    def _work(self, task, func, args, kwargs):
+        'Run a thread task on a worker thread. Used internally'
+        if task.cancelled:
+            raise TaskCancelled(task.name)
+        task.state = 'running'
+        return func(task, *args, **kwargs)
+
+    def _post(self, task, code):
+        'Push an event for task onto the SDL event queue from any thread. Used internally'
+        event = sdl2.SDL_Event()
+        event.type = TaskRunner.EVENT
+        event.user.code = code
+        event.user.data1 = task.id
+        sdl2.SDL_PushEvent(event)
+
+    @staticmethod
+    def _on_event(e):
+        'Update a Task on the main thread from its event. Used internally'
+        task = TaskRunner.TASKS.get(e.user.data1 or 0)
+        if task == None:
+            return
+        if e.user.code == TaskRunner.PROGRESS:
+            task._posted = False
+            task.progress, task.message = task._reported
+            changed = task._update_bindings() or not task.bindings
+            if task.on_progress:
+                task.on_progress(task)
+        else:
+            del TaskRunner.TASKS[task.id]
+            del task.runner.tasks[task.id]
+            future = task.future
+            if future.cancelled() or task.cancelled:
+                task.state = 'cancelled'
+            elif future.exception() != None:
+                task.error = future.exception()
+                task.state = 'cancelled' if isinstance(task.error,
+                        TaskCancelled) else 'failed'
+            else:
+                task.result = future.result()
+                task.state = 'done'
+                task.progress = 1
+            task._update_bindings()
+            changed = True
+            if task.on_done:
+                task.on_done(task)
+        if changed:
+            task.runner.inp.tasks.append(task)
+
+    def cancel_all(self):
+        'Cancel every unfinished task'
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+    def shutdown(self, wait=False):
+        '''
+        Cancel every task and stop the pools
+
+        wait: True to wait for running tasks to end
+        '''
+        self.cancel_all()
+        self.threads.shutdown(wait, cancel_futures=True)
+        if self.processes != None:
+            self.processes.shutdown(wait, cancel_futures=True)
+
+
+MEDIA_CACHE = 'media.cache'
+MEDIA_VERSION = 1 # change when MediaFile changes to ignore old caches
+MEDIA_EXTENSIONS = '.png', '.jpg', '.jpeg', '.gif', '.bmp'
+MediaFile = namedtuple('MediaFile', 'name path size mtime width height')
+
+def _media_key(f):
+    'Sort MediaFiles by name, ignoring case. Used internally'
+    return f.name.lower(), f.path
+
+class MediaIndex:
+    '''
+    A cached index of the media files in a folder tree, such as the
+    screenshots of a game list. The name, size, modification time and image
+    size of every file are kept in a cache file, so opening the index again
+    lists every file at once. scan() then only rereads the folders whose
+    modification time changed, and merges the files it finds into the
+    sorted entries and names in batches, so a Region showing names fills
+    in progressively while a new folder is scanned.
+
+        media = MediaIndex(image_path)
+        media.scan(runner)
+        gamelist.list = media.names
+        ...
+        if inp.tasks and media.update():
+            gamelist.list = media.names
+
+    path: folder to index, including its subfolders
+    extensions: file extensions to include, in lower case
+    cache: filename of the cache file, or None to keep no cache
+    '''
+    BATCH = 100 # new files found between progress reports
+    def __init__(self, path, extensions=MEDIA_EXTENSIONS, cache=MEDIA_CACHE):
+        self.path = os.path.abspath(path)
+        self.extensions = tuple(extensions)
+        self.cache = cache
+        self.task = None
+        self._found = []
+        self._lock = threading.Lock()
+        self._changed = False
+        # {folder: (mtime_ns, files, subfolders)}
+        self.folders = self._read_cache().get((self.path, self.extensions), {})
+        self._rebuild()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def scan(self, runner=None):
+        '''
+        Bring the index up to date with the files on disk, rereading only
+        the folders whose modification time changed, and save the cache
+
+        runner: a TaskRunner to scan in the background, or None to scan
+            before returning
+        RETURNS: the scan Task, or None without a runner
+        '''
+        if runner == None:
+            self._done(self._scan(None))
+            return None
+        self.task = runner.run(self._scan, name=f'scan {self.path}',
+                on_done=lambda task: self._done(task.result))
+        return self.task
+
+    def update(self):
+        '''
+        Merge the files found by a background scan since the last call into
+        the entries and names, which are replaced by new lists. Called on
+        the main thread, such as when inp.tasks lists the scan task
+
+        RETURNS: True if the entries changed since the last call
+        '''
+        with self._lock:
+            found, self._found = self._found, []
+        changed, self._changed = self._changed, False
+        if not found:
+            return changed
+        batch = sorted((f for files in found for f in files), key=_media_key)
+        self.entries = list(heapq.merge(self.entries, batch, key=_media_key))
+        self.names = [f.name for f in self.entries]
+        return True
+
+    def _done(self, folders):
+        'Use the folders of a finished scan. Used internally'
+        self.update()
+        if folders != None:
+            self.folders = folders
+            self._rebuild()
+            self._changed = True
+
+    def _rebuild(self):
+        'Rebuild the sorted entries and names from the folders. Used internally'
+        self.entries = sorted((f for mtime, files, subfolders in
+                self.folders.values() for f in files), key=_media_key)
+        self.names = [f.name for f in self.entries]
+
+    def _scan(self, task):
+        '''
+        Walk the folder tree, reusing the cached files of every folder that
+        is unchanged, and save the cache if anything changed. Runs on a
+        TaskRunner thread. Used internally
+
+        task: the scan Task to report progress to, or None
+        RETURNS: the new folders dict
+        '''
+        old = self.folders
+        folders = {}
+        stack = [self.path]
+        changed = len(old) == 0
+        new = []
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                changed = True
+                continue
+            cached = old.get(folder)
+            if cached and cached[0] == mtime:
+                folders[folder] = cached
+                stack.extend(cached[2])
+                continue
+            changed = True
+            files, subfolders = self._read_folder(folder, cached, new)
+            folders[folder] = mtime, files, subfolders
+            stack.extend(subfolders)
+            if len(new) >= self.BATCH or not stack:
+                with self._lock:
+                    self._found.append(new)
+                new = []
+                if task:
+                    task.report(None, folder)
+        if new:
+            with self._lock:
+                self._found.append(new)
+        if changed or len(folders) != len(old):
+            self._write_cache(folders)
+        return folders
+
+    def _read_folder(self, folder, cached, new):
+        '''
+        List the media files and subfolders of one folder, only reading the
+        header of files that are new or changed. Used internally
+
+        folder: path of the folder
+        cached: the folder's cached (mtime_ns, files, subfolders) or None
+        new: list that files missing from the entries are appended to
+        RETURNS: (files, subfolders)
+        '''
+        known = {f.path: f for f in cached[1]} if cached else {}
+        files = []; subfolders = []
+        try:
+            with os.scandir(folder) as entries:
+                for e in entries:
+                    try:
+                        if e.is_dir():
+                            subfolders.append(e.path)
+                            continue
+                        elif not e.name.lower().endswith(self.extensions):
+                            continue
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    f = known.get(e.path)
+                    if f == None:
+                        f = MediaFile(os.path.splitext(e.name)[0], e.path,
+                                st.st_size, st.st_mtime_ns, *image_size(e.path))
+                        new.append(f)
+                    elif f.size != st.st_size or f.mtime != st.st_mtime_ns:
+                        w, h = image_size(e.path)
+                        f = f._replace(size=st.st_size, mtime=st.st_mtime_ns,
+                                width=w, height=h)
+                    files.append(f)
+        except OSError as e:
+            print(f'Cannot read {folder}: {e}')
+        return files, subfolders
+
+    def _read_cache(self):
+        'Read the {(path, extensions): folders} dict of the cache file. Used internally'
+        if self.cache and os.path.isfile(self.cache):
+            try:
+                with open(self.cache, 'rb') as inp:
+                    data = pickle.load(inp)
+                if data['version'] == MEDIA_VERSION:
+                    return data['indexes']
+            except Exception as e:
+                print(f'Ignoring media cache {self.cache}: {e}')
+        return {}
+
+    def _write_cache(self, folders):
+        'Save folders into the cache file, keeping other indexes. Used internally'
+        if not self.cache:
+            return
+        indexes = self._read_cache()
+        indexes[self.path, self.extensions] = folders
+        folder, name = os.path.split(os.path.abspath(self.cache))
+        temp = None
+        try:
+            # a unique temporary file, so overlapping saves never share one
+            with tempfile.NamedTemporaryFile(dir=folder, prefix=name + '.',
+                    suffix='.tmp', delete=False) as out:
+                temp = out.name
+                pickle.dump({'version': MEDIA_VERSION, 'indexes': indexes}, out)
+            os.replace(temp, self.cache)
+        except OSError as e:
+            print(f'Cannot save media cache {self.cache}: {e}')
+            if temp and os.path.exists(temp):
+                os.remove(temp)
+
+
+def run_screen(screen, *args, **kwargs):
+    '''
+    Run a screen generator function with a blocking RunLoop until it returns
+
+    screen: generator function taking (loop, *args, **kwargs) that yields
+        once before every frame, see ScreenStack
+    RETURNS: the value returned by the screen
+    '''
+    loop = RunLoop()
+    gen = screen(loop, *args, **kwargs)
+    try:
+        while True:
+            try:
+                next(gen)
+            except StopIteration as e:
+                return e.value
+            loop.tick()
+    finally:
+        gen.close()
 
 def set_globals(*globs):
     '''
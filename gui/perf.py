@@ -0,0 +1,625 @@
+"""
+Copyright (C) 2020, Michael C Palmer <michaelcpalmer1980@gmail.com>
+
+This file is part of pySDL2gui
+
+pySDLgui is a simple, low level gui module that handles input and draws multiple
+rectangular Regions using hardware GPU rendering. Written in python, pySDLgui
+uses pySDL2, a low level SDL2 wrapper also written in pure python with no other
+dependencies.
+
+This file holds tools used to measure how fast pySDL2gui draws. They work by
+temporarily replacing the methods they measure with instrumented versions, so
+they cost nothing at all while they are switched off.
+
+CLASSES:
+    FrameStats: measures the time and draw calls of every frame, used to turn
+        input replays into load tests
+    Instrument: base class for tools that measure pySDL2gui by hooking methods
+    PerfHUD: an on screen overlay showing frame times, draw call counts, cache
+        hit rates, and the draw time of each Region
+    Tracer: records the phases of each frame and saves them as Chrome
+        trace-event JSON for Perfetto
+
+FUNCTIONS:
+    hook: replace a method with a measured version
+    region_name: get a short name for a Region to label measurements with
+    replay_session: replay recorded input through a GUI function and measure
+        every frame it draws
+    unhook: remove a hook installed by hook()
+
+pySDL2gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+pytmx is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+You should have received a copy of the GNU Lesser General Public
+License along with pySDL2gui.
+
+If not, see <http://www.gnu.org/licenses/>.
+"""
+import atexit, json, os
+from bisect import bisect_left
+from collections import deque
+from time import perf_counter
+from types import FunctionType
+import sdl2
+
+from .utility import Image
+from .gui import Region, ReplayFinished
+
+
+_pristine = {} # {(id(obj), name): (obj, own, value)} for hooked methods
+
+def hook(obj, name, func):
+    '''
+    Replace a method of a class or object with a measured version. Hooks
+    from several tools may be stacked on one method and removed in any order.
+
+    :param obj: the class or object that owns the method
+    :param name: str name of the method
+    :param func: function(inner, *args, **kwargs) that must call inner with
+        the same arguments to run the method it replaces
+    :rvalue function: the installed hook, to pass to unhook() later
+    '''
+    key = id(obj), name
+    if key not in _pristine:
+        _pristine[key] = obj, name in vars(obj), vars(obj).get(name)
+    link = [getattr(obj, name)]
+    def hooked(*args, **kwargs):
+        return func(link[0], *args, **kwargs)
+    hooked.link = link
+    setattr(obj, name, hooked)
+    return hooked
+
+def unhook(obj, name, hooked):
+    '''
+    Remove a hook installed by hook(), restoring the original method once
+    no hooks remain
+
+    :param obj: the class or object that owns the method
+    :param name: str name of the method
+    :param hooked: the hook returned by hook()
+    '''
+    current = getattr(obj, name)
+    if current is hooked:
+        inner = hooked.link[0]
+        if _is_hook(inner):
+            setattr(obj, name, inner)
+        else:
+            obj, own, value = _pristine.pop((id(obj), name))
+            if own:
+                setattr(obj, name, value)
+            else:
+                delattr(obj, name)
+        return
+    while _is_hook(current): # unlink from the middle of the chain
+        if current.link[0] is hooked:
+            current.link[0] = hooked.link[0]
+            return
+        current = current.link[0]
+
+def _is_hook(func):
+    'Check if func was installed by hook(), not a bound method. Used internally'
+    return isinstance(func, FunctionType) and 'link' in func.__dict__
+
+
+def region_name(region):
+    '''
+    Get a short name for a Region, used to label its measurements
+
+    :param region: a gui.Region
+    :rvalue str: the Region's name attribute, or its area if it has no name
+    '''
+    a = region.area
+    return region.name or f'{a.x},{a.y} {a.width}x{a.height}'
+
+
+class Instrument():
+    '''
+    The Instrument class is the base for tools that measure pySDL2gui by
+    hooking its methods. Subclasses install their hooks with _hook() in
+    enable(), and disable() removes them again.
+    '''
+    COMBO = None # input combination bound by bind()
+    def __init__(self):
+        self.enabled = False
+        self._hooks = []
+
+    def bind(self, inp, combo=None):
+        '''
+        Toggle the instrument when an input combination is held together
+
+        :param inp: the gui.InputHandler to bind to
+        :param combo: list of input strings, or the class COMBO by default
+        '''
+        inp.bind(combo or self.COMBO, self.toggle)
+
+    def toggle(self):
+        'Enable the instrument if disabled, otherwise disable it'
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def enable(self):
+        'Install the hooks and start measuring'
+        self.enabled = True
+
+    def disable(self):
+        'Remove the hooks and stop measuring'
+        for obj, name, hooked in reversed(self._hooks):
+            unhook(obj, name, hooked)
+        self._hooks = []
+        self.enabled = False
+
+    def _hook(self, obj, name, func):
+        'Hook a method until disable() is called. Used internally'
+        self._hooks.append((obj, name, hook(obj, name, func)))
+
+
+class PerfHUD(Instrument):
+    '''
+    The PerfHUD class draws a performance overlay over the screen each time it is
+    presented. It shows the average frame time, fps, draw calls, texture switches,
+    and glyphs drawn over the last few frames, the hit rates of the image and
+    font caches, and the draw time of each Region, not counting the Regions
+    drawn inside it. While enabled it hooks Region.draw, Image.draw_in,
+    FontManager.draw and the renderer's drawing methods with measured versions,
+    and removes the hooks when disabled.
+    '''
+    COMBO = ('L', 'R', 'X') # input combination that toggles the overlay
+    FRAMES = 60 # number of frames to average measurements over
+    def __init__(self, renderer, fonts, images, font=('Roboto.ttf', 14),
+            frames=None):
+        '''
+        Create a new, disabled performance overlay
+
+        :param renderer: sdl2.ext.Renderer that frames are presented with
+        :param fonts: the gui.FontManager to measure and draw text with
+        :param images: the gui.ImageManager to measure
+        :param font: (filename, size) font to draw the overlay with
+        :param frames: number of frames to average, PerfHUD.FRAMES by default
+        '''
+        super().__init__()
+        self.renderer = renderer
+        self.fonts = fonts
+        self.images = images
+        self.font = font
+        self.history = deque(maxlen=frames or PerfHUD.FRAMES)
+        self.region_stack = []
+        self._reset()
+
+    def enable(self):
+        'Install the measured methods and start drawing the overlay'
+        if self.enabled:
+            return
+        super().enable()
+        self.history.clear()
+        self.region_stack = []
+        self._reset()
+        self.last_frame = perf_counter()
+        hud = self
+
+        def region_draw(draw, region, *args, **kwargs):
+            # time spent in nested Region draws is charged to the nested
+            # Region only, so each Region reports its exclusive time
+            hud.region_stack.append(0)
+            start = perf_counter()
+            try:
+                return draw(region, *args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                children = hud.region_stack.pop()
+                if hud.region_stack:
+                    hud.region_stack[-1] += elapsed
+                name = region_name(region)
+                hud.regions[name] = (hud.regions.get(name, 0) +
+                        elapsed - children)
+        self._hook(Region, 'draw', region_draw)
+
+        def text_draw(draw, *args, **kwargs):
+            hud.text_depth += 1
+            start = perf_counter()
+            try:
+                return draw(*args, **kwargs)
+            finally:
+                hud.text_depth -= 1
+                hud.text_time += perf_counter() - start
+        self._hook(self.fonts, 'draw', text_draw)
+
+        def image_draw_in(draw_in, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return draw_in(*args, **kwargs)
+            finally:
+                hud.image_time += perf_counter() - start
+        self._hook(Image, 'draw_in', image_draw_in)
+
+        def image_load(load, fn, *args, **kwargs):
+            if isinstance(fn, str):
+                hud.image_hits += fn in hud.images.images
+                hud.image_loads += 1
+            return load(fn, *args, **kwargs)
+        self._hook(self.images, 'load', image_load)
+
+        def font_load(load, filename, size=None):
+            key = (filename, size) if size else tuple(filename)
+            hud.font_hits += key in hud.fonts.fonts
+            hud.font_loads += 1
+            return load(filename, size)
+        self._hook(self.fonts, 'load', font_load)
+
+        def copy(copy, texture, *args, **kwargs):
+            hud.calls += 1
+            if texture is not hud.last_texture:
+                hud.switches += 1
+                hud.last_texture = texture
+            if hud.text_depth:
+                hud.glyphs += 1
+            return copy(texture, *args, **kwargs)
+        self._hook(self.renderer, 'copy', copy)
+
+        def counted(method, *args, **kwargs):
+            hud.calls += 1
+            return method(*args, **kwargs)
+        for name in ('fill', 'draw_rect', 'draw_line', 'draw_point'):
+            if hasattr(self.renderer, name):
+                self._hook(self.renderer, name, counted)
+
+        def present(present):
+            hud._end_frame()
+            present()
+        self._hook(self.renderer, 'present', present)
+
+    def _reset(self):
+        'Reset the measurements for a new frame. Used internally'
+        self.calls = self.switches = self.glyphs = 0
+        self.text_depth = 0
+        self.text_time = self.image_time = 0
+        self.image_hits = self.image_loads = 0
+        self.font_hits = self.font_loads = 0
+        self.last_texture = None
+        self.regions = {}
+
+    def _end_frame(self):
+        '''
+        Record the measurements of the frame being presented, draw the
+        overlay on top of it, and start measuring the next frame
+        '''
+        now = perf_counter()
+        self.history.append(dict(
+            time=now - self.last_frame, calls=self.calls,
+            switches=self.switches, glyphs=self.glyphs,
+            text=self.text_time, image=self.image_time,
+            image_hits=self.image_hits, image_loads=self.image_loads,
+            font_hits=self.font_hits, font_loads=self.font_loads,
+            regions=self.regions))
+        self.draw()
+        self._reset()
+        self.last_frame = perf_counter()
+
+    def stats(self):
+        '''
+        Average the measurements of the recorded frames
+
+        :rvalue dict: averaged values, with 'regions' holding a dict of
+            {Region name: average draw time in ms}
+        '''
+        n = len(self.history) or 1
+        total = {}
+        regions = {}
+        for frame in self.history:
+            for k, v in frame.items():
+                if k == 'regions':
+                    for name, t in v.items():
+                        regions[name] = regions.get(name, 0) + t
+                else:
+                    total[k] = total.get(k, 0) + v
+
+        frame_ms = total.get('time', 0) * 1000 / n
+        def rate(hits, loads):
+            return hits / loads if loads else 1.0
+        return dict(
+            frame_ms=frame_ms,
+            fps=1000 / frame_ms if frame_ms else 0,
+            calls=total.get('calls', 0) / n,
+            switches=total.get('switches', 0) / n,
+            glyphs=total.get('glyphs', 0) / n,
+            text_ms=total.get('text', 0) * 1000 / n,
+            image_ms=total.get('image', 0) * 1000 / n,
+            image_hit_rate=rate(total.get('image_hits', 0),
+                    total.get('image_loads', 0)),
+            font_hit_rate=rate(total.get('font_hits', 0),
+                    total.get('font_loads', 0)),
+            regions={k: v * 1000 / n for k, v in sorted(
+                    regions.items(), key=lambda i: -i[1])})
+
+    def lines(self):
+        '''
+        Format the averaged measurements as lines of text for the overlay
+
+        :rvalue []: list of strings
+        '''
+        s = self.stats()
+        lines = [
+            f'frame {s["frame_ms"]:.1f}ms  fps {s["fps"]:.1f}',
+            f'draws {s["calls"]:.0f}  tex {s["switches"]:.0f}  '
+                f'glyphs {s["glyphs"]:.0f}',
+            f'text {s["text_ms"]:.1f}ms  images {s["image_ms"]:.1f}ms',
+            f'cache images {s["image_hit_rate"]:.0%}  '
+                f'fonts {s["font_hit_rate"]:.0%}']
+        for name, ms in s['regions'].items():
+            lines.append(f'{name} {ms:.2f}ms')
+        return lines
+
+    def draw(self):
+        'Draw the overlay in the top left corner of the screen'
+        lines = self.lines()
+        self.fonts.load(*self.font)
+        height = self.fonts.height
+        width = max(self.fonts.width(l) for l in lines) + 8
+        mode, self.renderer.blendmode = (self.renderer.blendmode,
+                sdl2.SDL_BLENDMODE_BLEND)
+        self.renderer.fill((0, 0, width, height * len(lines) + 8), (0,0,0,180))
+        y = 4
+        for line in lines:
+            self.fonts.draw(line, 4, y, (255,255,0))
+            y += height
+        self.renderer.blendmode = mode
+
+
+class Tracer(Instrument):
+    '''
+    The Tracer class records timestamped spans for the phases of each frame
+    into a ring buffer: input processing, the update and draw of each Region,
+    image and font loading, sound playback, and presenting the screen. save()
+    writes them as Chrome trace-event JSON, which can be opened in Perfetto or
+    chrome://tracing to find exactly which frame stuttered and why. Like the
+    PerfHUD, it only hooks these methods while enabled.
+    '''
+    COMBO = ('L', 'R', 'Y') # input combination that saves the trace
+    EVENTS = 100000 # number of spans kept in the ring buffer
+    def __init__(self, renderer, fonts, images, inp, sounds=None,
+            filename='trace.json', events=None):
+        '''
+        Create a new, disabled Tracer
+
+        :param renderer: sdl2.ext.Renderer that frames are presented with
+        :param fonts: the gui.FontManager to trace
+        :param images: the gui.ImageManager to trace
+        :param inp: the gui.InputHandler to trace
+        :param sounds: optional gui.SoundManager to trace
+        :param filename: default file that save() writes into
+        :param events: number of spans to keep, Tracer.EVENTS by default
+        '''
+        super().__init__()
+        self.renderer = renderer
+        self.fonts = fonts
+        self.images = images
+        self.inp = inp
+        self.sounds = sounds
+        self.filename = filename
+        self.events = deque(maxlen=events or Tracer.EVENTS)
+        self.start = perf_counter()
+        self.frame = 0
+        self._at_exit = False
+
+    def bind(self, inp, combo=None):
+        '''
+        Save the trace when an input combination is held together
+
+        :param inp: the gui.InputHandler to bind to
+        :param combo: list of input strings, Tracer.COMBO by default
+        '''
+        inp.bind(combo or self.COMBO, self.save)
+
+    def enable(self):
+        'Install the traced methods and save the trace on exit'
+        if self.enabled:
+            return
+        super().enable()
+        if not self._at_exit:
+            atexit.register(self._exit)
+            self._at_exit = True
+
+        def traced(name, cat, args=None):
+            def span(method, *a, **kw):
+                info = args(*a) if args else None
+                start = perf_counter()
+                try:
+                    return method(*a, **kw)
+                finally:
+                    self.span(name, cat, start, perf_counter(), info)
+            return span
+
+        def region(phase):
+            def span(method, region, *a, **kw):
+                start = perf_counter()
+                try:
+                    return method(region, *a, **kw)
+                finally:
+                    self.span(f'{region_name(region)}.{phase}', 'region',
+                            start, perf_counter())
+            return span
+
+        self._hook(self.inp, 'process', traced('InputHandler.process', 'input'))
+        self._hook(Region, 'update', region('update'))
+        self._hook(Region, 'draw', region('draw'))
+        self._hook(self.images, 'load', traced('ImageManager.load', 'load',
+                lambda fn=None, *a: {'file': str(fn),
+                        'cached': fn in self.images.images}))
+        self._hook(self.fonts, 'load', traced('FontManager.load', 'load',
+                lambda filename, size=None: {'font': str(filename),
+                        'size': str(size)}))
+        if self.sounds:
+            self._hook(self.sounds, 'play', traced('SoundManager.play', 'sound',
+                    lambda name=None, *a: {'sound': str(name)}))
+
+        def present(method):
+            start = perf_counter()
+            try:
+                return method()
+            finally:
+                self.span('present', 'frame', start, perf_counter(),
+                        {'frame': self.frame})
+                self.frame += 1
+        self._hook(self.renderer, 'present', present)
+
+    def span(self, name, cat, start, end, args=None):
+        '''
+        Record a span in the ring buffer
+
+        :param name: str name of the span
+        :param cat: str category of the span
+        :param start: perf_counter() time the span started
+        :param end: perf_counter() time the span ended
+        :param args: optional dict of values to show with the span
+        '''
+        self.events.append((name, cat, start, end, args))
+
+    def trace(self):
+        '''
+        Convert the recorded spans into Chrome trace-event format
+
+        :rvalue dict: a trace that can be saved with json.dump()
+        '''
+        pid = os.getpid()
+        events = []
+        for name, cat, start, end, args in self.events:
+            e = {'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': 1,
+                 'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6}
+            if args:
+                e['args'] = args
+            events.append(e)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, filename=None):
+        '''
+        Write the recorded spans into a Chrome trace-event JSON file
+
+        :param filename: file to write, or the Tracer's filename by default
+        :rvalue str: the filename written
+        '''
+        filename = filename or self.filename
+        with open(filename, 'w') as out:
+            json.dump(self.trace(), out)
+        print(f'Saved {len(self.events)} trace events into {filename}')
+        return filename
+
+    def _exit(self):
+        'Save the trace when the program exits, if enabled. Used internally'
+        if self.enabled and self.events:
+            self.save()
+
+
+class FrameStats(Instrument):
+    '''
+    The FrameStats class measures the time and the draw calls of every frame
+    from the first input processed to the screen being presented. It is used
+    to turn recorded input replays into repeatable load tests.
+    '''
+    BINS = (1, 2, 4, 8, 16, 33, 50, 100) # upper edges of histogram bins in ms
+    def __init__(self, renderer, inp):
+        '''
+        Create new, disabled frame statistics
+
+        :param renderer: sdl2.ext.Renderer that frames are presented with
+        :param inp: the gui.InputHandler processed at the start of each frame
+        '''
+        super().__init__()
+        self.renderer = renderer
+        self.inp = inp
+        self.times = []
+        self.calls = []
+        self._start = None
+        self._calls = 0
+
+    def enable(self):
+        'Install the measured methods and start recording frames'
+        if self.enabled:
+            return
+        super().enable()
+        stats = self
+
+        def process(method, *args, **kwargs):
+            if stats._start == None:
+                stats._start = perf_counter()
+            return method(*args, **kwargs)
+        self._hook(self.inp, 'process', process)
+
+        def counted(method, *args, **kwargs):
+            stats._calls += 1
+            return method(*args, **kwargs)
+        for name in ('copy', 'fill', 'draw_rect', 'draw_line', 'draw_point'):
+            if hasattr(self.renderer, name):
+                self._hook(self.renderer, name, counted)
+
+        def present(method):
+            result = method()
+            now = perf_counter()
+            stats.times.append(now - (stats._start or now))
+            stats.calls.append(stats._calls)
+            stats._start = None
+            stats._calls = 0
+            return result
+        self._hook(self.renderer, 'present', present)
+
+    def histogram(self):
+        '''
+        Count the recorded frames by frame time
+
+        :rvalue []: list of (label, count) pairs, one for each of the BINS
+            and a final one for slower frames
+        '''
+        counts = [0] * (len(self.BINS) + 1)
+        for t in self.times:
+            counts[bisect_left(self.BINS, t * 1000)] += 1
+        labels = [f'<={b}ms' for b in self.BINS] + [f'>{self.BINS[-1]}ms']
+        return list(zip(labels, counts))
+
+    def report(self):
+        '''
+        Summarize the recorded frames
+
+        :rvalue dict: frame count, total draw calls, frame time percentiles in
+            ms, and the frame time histogram
+        '''
+        times = sorted(self.times)
+        def percentile(p):
+            return times[min(len(times)-1, int(len(times) * p))] * 1000 if times else 0
+        return {
+            'frames': len(times),
+            'draw_calls': sum(self.calls),
+            'mean_ms': sum(times) * 1000 / len(times) if times else 0,
+            'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99), 'max_ms': times[-1] * 1000 if times else 0,
+            'histogram': dict(self.histogram())}
+
+
+def replay_session(filename, renderer, inp, func, *args):
+    '''
+    Replay recorded input through a GUI function and measure every frame it
+    draws, turning a recorded session into a repeatable load test
+
+    :param filename: input recording saved by InputHandler.record()
+    :param renderer: sdl2.ext.Renderer that frames are presented with
+    :param inp: the gui.InputHandler that func reads input from
+    :param func: the GUI function to run, such as a main menu loop
+    :param args: arguments for func
+    :rvalue dict: the FrameStats.report() of the replay
+    '''
+    stats = FrameStats(renderer, inp)
+    inp.replay(filename)
+    stats.enable()
+    try:
+        func(*args)
+    except ReplayFinished:
+        pass
+    finally:
+        stats.disable()
+        inp.replaying = None
+    return stats.report()
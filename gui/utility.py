@@ -25,15 +25,23 @@ CLASSES:
         regions onto a pySDL render context
     ImageManager: class to load and cache images as Image objects in
         texture memory
+    Layers: a read-only view of nested dicts layered over each other, used
+        to merge the theme and Region parameters without copying them
     Rect: class used to represent and modify Rectangular regions
+    RectArray: many rectangles in one numpy array for bulk layout and hit
+        testing, requires numpy
+    Resources: finds asset files by name, only scanning the assets folder
+        when needed
     SoundManager: class used to load and play sound effects and music
+    Startup: records the startup timeline and runs deferred startup tasks
 
 FUNCTIONS:
-    deep_merge: used internally to merge option dicts
+    deep_merge: merge two option dicts into a new copy
     deep_print: available to display nested dict items or save them to disk
-    deep_update: used internally to update an options dict from a second one
+    deep_update: update an options dict from a second one
     get_color_mod: get the color_mod value of a texture (not working)
     get_text_size: get the size a text string would be if drawn with given font
+    image_size: read the size of an image file from its header
     range_list: generate a list of numerical values to select from in a option
         menu, similar to a slider widget
     set_color_mod: set the color_mod value of a texture (not working)
@@ -54,10 +62,51 @@ If not, see <http://www.gnu.org/licenses/>.
 """
 
 from ctypes import c_int, c_ubyte, byref
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from collections import deque
+from time import perf_counter
 import sdl2, sdl2.ext
-import os, random
-global RESOURCES, sounds
-RESOURCES = sdl2.ext.Resources(__file__, '../assets')
+import os, sys, random, struct, threading
+global RESOURCES, sounds, startup
+_np = None # optional numpy, imported by _numpy() when a RectArray is first made
+
+
+class Resources():
+    '''
+    Finds asset files by name. A name is first looked up directly in the
+    assets folder, and the folder is only scanned, with a
+    sdl2.ext.Resources, the first time a name is not found there. This
+    keeps importing pySDL2gui from walking the whole assets tree. Found
+    paths are remembered in the paths dict, which compile_theme() also
+    fills from its cache.
+
+    :param path: folder to find assets in
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.paths = {} # {filename: path} already found
+
+    def get_path(self, filename):
+        '''
+        Get the full path of an asset file
+
+        :param filename: name of the file, or a path relative to the assets folder
+        :rvalue str: the absolute path to the file, raises KeyError if not found
+        '''
+        path = self.paths.get(filename)
+        if path:
+            return path
+        path = os.path.join(self.path, filename)
+        if not os.path.isfile(path):
+            if self.index == None:
+                self.index = sdl2.ext.Resources(self.path)
+            path = self.index.get_path(filename)
+        self.paths[filename] = path
+        return path
+RESOURCES = Resources(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'assets'))
 
 class Point:
     def __init__(self, x, y):
@@ -65,15 +114,29 @@ class Point:
         self.y = y
 
 class Rect:
+    '''
+    A rectangle with integer position and size. Rects are slotted, and
+    the in-place methods (copy_from, crop, fit, inflate, move, update) change
+    and return the Rect itself, so drawing code can reuse scratch Rects
+    instead of creating new ones every frame. Methods ending in -ed, and
+    clip(), return new Rects.
+    '''
     POINTS = ('topleft midtop topright midleft center midright '+
               'bottomleft midbottom bottomright').split()
+    __slots__ = ('x', 'y', 'width', 'height', '_sdl')
     def __init__(self, x, y, width, height):
         self.x = int(x)
         self.y = int(y)
         self.width = int(width)
         self.height = int(height)
+        self._sdl = None
     def __repr__(self):
         return f'Rect({self.x},{self.y},{self.width},{self.height})'
+    def __getstate__(self):
+        return self.x, self.y, self.width, self.height
+    def __setstate__(self, state):
+        self.x, self.y, self.width, self.height = state
+        self._sdl = None
     
     def __mul__(self, v):
         'Scale by v keeping center in position'
@@ -88,25 +151,33 @@ class Rect:
         'Returns a copy of the called Rect object'
         return Rect(self.x, self.y, self.width, self.height)    
 
-    def fit(self, other):
-        'Move and resize myself to fill other rect maintaining aspect ratio'
-        r = self.fitted(other)
-        self.x = r.x; self.width = r.width
-        self.y = r.y; self.height = r.height
+    def copy_from(self, other):
+        '''
+        Set my position and size to those of other, a Rect or an SDL_Rect,
+        and return myself'''
+        self.x = other.x; self.width = other.w
+        self.y = other.y; self.height = other.h
+        return self
 
-    def fitted(self, other):
+    def fit(self, other):
         '''
-        Return new Rect with other centered and resized to fill self.
-        Aspect ration is retained'''
+        Move and resize myself to fill other rect maintaining aspect ratio,
+        and return myself'''
         xr = self.width / other.width
         yr = self.height / other.height
         mr = xr if yr < xr else yr
 
-        w = int(self.width / mr)
-        h = int(self.height / mr)
-        x = int(other.x + (other.width - w) / 2)
-        y = int(other.y + (other.height - h) / 2)
-        return Rect(x, y, w, h)
+        self.width = int(self.width / mr)
+        self.height = int(self.height / mr)
+        self.x = int(other.x + (other.width - self.width) / 2)
+        self.y = int(other.y + (other.height - self.height) / 2)
+        return self
+
+    def fitted(self, other):
+        '''
+        Return new Rect with other centered and resized to fill self.
+        Aspect ration is retained'''
+        return self.copy().fit(other)
 
     def from_corners(x, y, x2, y2):
         '''
@@ -121,13 +192,14 @@ class Rect:
 
     def inflate(self, x, y=None):
         '''
-        Add x to width and y to height of rect, or x to both.
-        The rect will remain centered around the same point'''
+        Add x to width and y to height of rect, or x to both, and return
+        myself. The rect will remain centered around the same point'''
         y = y if y != None else x
         self.x -= x // 2
         self.y -= y // 2
         self.width += x
         self.height += y
+        return self
     def inflated(self, x, y=None):
         '''
         Return a copy of self with x added to the width and y to the
@@ -141,9 +213,10 @@ class Rect:
         return Rect(nx, ny, nw, nh)
     
     def move(self, x, y):
-        'Move self by x/y pixels'
+        'Move self by x/y pixels and return myself'
         self.x += x
         self.y += y
+        return self
     def moved(self, x, y):
         'Return copy of self moved by x/y pixels'
         return Rect(
@@ -151,52 +224,44 @@ class Rect:
             self.width, self.height)
 
     def sdl(self):
-        'Return my value as an sdl_rect'
-        return sdl2.SDL_Rect(self.x, self.y, self.width, self.height)
+        '''
+        Return my value as an sdl_rect. The same SDL_Rect is updated and
+        returned by every call, so copy it if it must be kept unchanged'''
+        r = self._sdl
+        if r is None:
+            r = self._sdl = sdl2.SDL_Rect(self.x, self.y, self.width, self.height)
+        else:
+            r.x = self.x; r.w = self.width
+            r.y = self.y; r.h = self.height
+        return r
     def tuple(self):
         'Return my value as a 4-tuple'
         return self.x, self.y, self.width, self.height
 
     def update(self, x, y, w, h):
-        'Update myself with new position and size'
+        'Update myself with new position and size, and return myself'
         self.x = x; self.width = w
         self.y = y; self.height = h
+        return self
 
-    def clip(self, other):
-        'Return copy of self cropped to fit inside other Rect'
-        # LEFT
-        if self.x >= other.x and self.x < other.x + other.width:
-            x = self.x
-        elif other.x >= self.x and other.x < self.x + self.width:
-            x = other.x
-        else:
-            return Rect(self.x, self.y, 0,0)
-
-        # RIGHT
-        if self.x + self.width > other.x and self.x + self.width <= other.x + other.width:
-            w = self.x + self.width - x
-        elif other.x + other.width > self.x and other.x + other.width <= self.x + self.width:
-            w = other.x + other.width - x
-        else:
-            return Rect(self.x, self.y, 0,0)
-
-        # TOP
-        if self.y >= other.y and self.y < other.y + other.height:
-            y = self.y
-        elif other.y >= self.y and other.y < self.y + self.height:
-            y = other.y
-        else:
-            return Rect(self.x, self.y, 0,0)
-
-        # BOTTOM
-        if self.y + self.height > other.y and self.y + self.height <= other.y + other.height:
-            h = self.y + self.height - y
-        elif other.y + other.height > self.y and other.y + other.height <= self.y + self.height:
-            h = other.y + other.height - y
+    def crop(self, other):
+        '''
+        Crop myself to fit inside other Rect and return myself. If we do not
+        overlap, my width and height become 0'''
+        x = max(self.x, other.x)
+        y = max(self.y, other.y)
+        right = min(self.x + self.width, other.x + other.width)
+        bottom = min(self.y + self.height, other.y + other.height)
+        if right <= x or bottom <= y:
+            self.width = self.height = 0
         else:
-            return Rect(self.x, self.y, 0,0)
+            self.x = x; self.width = right - x
+            self.y = y; self.height = bottom - y
+        return self
 
-        return Rect(x, y, w, h)
+    def clip(self, other):
+        'Return copy of self cropped to fit inside other Rect'
+        return self.copy().crop(other)
 
     @property
     def w(self):
@@ -330,7 +395,7 @@ class Rect:
     def bottomright(self):
         return self.x+self.width, self.y+self.height
     @bottomright.setter
-    def botomright(self, v):
+    def bottomright(self, v):
         x, y = v
         self.x = x - self.width
         self.y = y - self.height
@@ -344,6 +409,313 @@ class Rect:
         self.width, self.height = v
         self.center = cx, cy
    
+def _numpy():
+    'Import numpy on first use, as it is optional and slow to import'
+    global _np
+    if _np == None:
+        try:
+            import numpy as _np
+        except ImportError:
+            _np = False
+    if not _np:
+        raise Exception('RectArray requires numpy')
+    return _np
+
+class RectArray:
+    '''
+    Many rectangles stored as one numpy array, so they can be laid out, moved
+    and hit tested together with a few array operations instead of one Rect
+    at a time. The data array has one (x, y, width, height) row of 32 bit
+    ints per rectangle, which is the memory layout of an array of SDL_Rects,
+    so sdl() hands it to SDL without copying. Like Rect, the in-place
+    methods return the RectArray itself and the -ed methods return copies.
+    Requires numpy, which is only imported when a RectArray is first made.
+
+        keys = RectArray.run(area.x, area.y, widths, 40, space=4)
+        keys.align('midleft', area.x, area.centery)
+        pressed = keys.index(x, y)
+        keys.fill(renderer, (80, 80, 80))
+
+    :param data: a sequence of Rects or (x, y, width, height) rows, or an int
+        number of empty rectangles
+    '''
+    ANCHORS = {'topleft': (0, 0), 'midtop': (1, 0), 'topright': (2, 0),
+            'midleft': (0, 1), 'center': (1, 1), 'midright': (2, 1),
+            'bottomleft': (0, 2), 'midbottom': (1, 2), 'bottomright': (2, 2)}
+    def __init__(self, data=0):
+        np = _numpy()
+        if isinstance(data, int):
+            self.data = np.zeros((data, 4), np.int32)
+        else:
+            data = [r.tuple() if isinstance(r, Rect) else r for r in data]
+            self.data = np.array(data, np.int32).reshape(-1, 4)
+    def __repr__(self):
+        return f'RectArray({self.data.tolist()})'
+    def __len__(self):
+        return len(self.data)
+    def __getitem__(self, i):
+        'Return rectangle i as a new Rect'
+        return Rect(*self.data[i])
+
+    def copy(self):
+        'Return a copy of the RectArray'
+        r = RectArray.__new__(RectArray)
+        r.data = self.data.copy()
+        return r
+
+    def rows(area, count, height):
+        '''
+        Create count rectangles of the given height stacked down from the
+        top of area, such as the rows of a list page
+
+        :param area: Rect the rows are as wide as and start at the top of
+        :param count: number of rows
+        :param height: height of each row
+        :rvalue RectArray: the rows
+        '''
+        np = _numpy()
+        r = RectArray(count)
+        r.data[:, 0] = area.x
+        r.data[:, 1] = area.y + np.arange(count, dtype=np.int32) * height
+        r.data[:, 2] = area.width
+        r.data[:, 3] = height
+        return r
+
+    def run(x, y, widths, height, space=0):
+        '''
+        Create a horizontal run of rectangles placed side by side, such as
+        the glyphs of a string, the items of a bar or a row of keys
+
+        :param x: x coordinate of the first rectangle
+        :param y: y coordinate of every rectangle
+        :param widths: sequence of widths, one per rectangle
+        :param height: height of every rectangle
+        :param space: extra space between rectangles
+        :rvalue RectArray: the rectangles
+        '''
+        np = _numpy()
+        widths = np.asarray(widths, np.int32)
+        r = RectArray(len(widths))
+        r.data[1:, 0] = np.cumsum(widths[:-1] + space)
+        r.data[:, 0] += x
+        r.data[:, 1] = y
+        r.data[:, 2] = widths
+        r.data[:, 3] = height
+        return r
+
+    # COLUMNS
+    @property
+    def x(self):
+        return self.data[:, 0]
+    @property
+    def y(self):
+        return self.data[:, 1]
+    @property
+    def width(self):
+        return self.data[:, 2]
+    @property
+    def height(self):
+        return self.data[:, 3]
+    @property
+    def right(self):
+        return self.data[:, 0] + self.data[:, 2]
+    @property
+    def bottom(self):
+        return self.data[:, 1] + self.data[:, 3]
+
+    def bounds(self):
+        'Return a Rect enclosing every rectangle'
+        if not len(self.data):
+            return Rect(0, 0, 0, 0)
+        return Rect.from_corners(self.x.min(), self.y.min(),
+                self.right.max(), self.bottom.max())
+
+    # IN PLACE
+    def move(self, x, y):
+        '''
+        Move every rectangle by x/y pixels and return myself. x and y may
+        be numbers or arrays with one value per rectangle'''
+        self.data[:, 0] += x
+        self.data[:, 1] += y
+        return self
+
+    def inflate(self, x, y=None):
+        '''
+        Add x to the width and y to the height of every rectangle, or x to
+        both, keeping them centered, and return myself'''
+        y = y if y is not None else x
+        self.data[:, 0] -= x // 2
+        self.data[:, 1] -= y // 2
+        self.data[:, 2] += x
+        self.data[:, 3] += y
+        return self
+
+    def align(self, point, x, y):
+        '''
+        Move every rectangle so the given point of it is at x, y, and return
+        myself. x and y may be numbers or arrays with one value per rectangle
+
+        :param point: one of the Rect.POINTS, such as 'midleft' or 'center'
+        :param x: x coordinate to place the point at
+        :param y: y coordinate to place the point at
+        '''
+        ax, ay = self.ANCHORS[point]
+        self.data[:, 0] = x - (self.data[:, 2] * ax) // 2
+        self.data[:, 1] = y - (self.data[:, 3] * ay) // 2
+        return self
+
+    def fit(self, other):
+        '''
+        Resize every rectangle to fill other, keeping its aspect ratio and
+        centering it, and return myself
+
+        :param other: a Rect to fit every rectangle into, or a RectArray of
+            the same length to fit each rectangle into its own area
+        '''
+        np = _np
+        ox, oy, ow, oh = _columns(other)
+        w, h = self.data[:, 2], self.data[:, 3]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.maximum(w / ow, h / oh)
+            nw = np.nan_to_num(w / ratio).astype(np.int32)
+            nh = np.nan_to_num(h / ratio).astype(np.int32)
+        self.data[:, 0] = (ox + (ow - nw) / 2).astype(np.int32)
+        self.data[:, 1] = (oy + (oh - nh) / 2).astype(np.int32)
+        self.data[:, 2] = nw
+        self.data[:, 3] = nh
+        return self
+
+    def crop(self, other):
+        '''
+        Crop every rectangle to fit inside other and return myself.
+        Rectangles that do not overlap it get a width and height of 0
+
+        :param other: a Rect, or a RectArray of the same length
+        '''
+        np = _np
+        ox, oy, ow, oh = _columns(other)
+        x = np.maximum(self.data[:, 0], ox)
+        y = np.maximum(self.data[:, 1], oy)
+        w = np.minimum(self.right, ox + ow) - x
+        h = np.minimum(self.bottom, oy + oh) - y
+        hit = (w > 0) & (h > 0)
+        self.data[:, 0] = np.where(hit, x, self.data[:, 0])
+        self.data[:, 1] = np.where(hit, y, self.data[:, 1])
+        self.data[:, 2] = np.where(hit, w, 0)
+        self.data[:, 3] = np.where(hit, h, 0)
+        return self
+
+    # COPIES
+    def moved(self, x, y):
+        'Return a copy with every rectangle moved by x/y pixels'
+        return self.copy().move(x, y)
+    def inflated(self, x, y=None):
+        'Return a copy with x added to every width and y to every height'
+        return self.copy().inflate(x, y)
+    def fitted(self, other):
+        'Return a copy with every rectangle fitted into other'
+        return self.copy().fit(other)
+    def clip(self, other):
+        'Return a copy with every rectangle cropped to fit inside other'
+        return self.copy().crop(other)
+
+    # QUERIES
+    def contains(self, x, y):
+        '''
+        Test which rectangles contain the point x, y
+
+        :rvalue array: numpy array of bools, one per rectangle
+        '''
+        d = self.data
+        return ((d[:, 0] <= x) & (x < d[:, 0] + d[:, 2]) &
+                (d[:, 1] <= y) & (y < d[:, 1] + d[:, 3]))
+
+    def index(self, x, y):
+        '''
+        Find the first rectangle containing the point x, y
+
+        :rvalue int: index of the rectangle, or -1 if none contain it
+        '''
+        hits = _np.flatnonzero(self.contains(x, y))
+        return int(hits[0]) if len(hits) else -1
+
+    # SDL
+    def sdl(self):
+        '''
+        Return the rectangles as a ctypes array of SDL_Rects that shares
+        memory with the data array, for SDL functions such as
+        SDL_RenderFillRects and SDL_RenderDrawRects'''
+        return (sdl2.SDL_Rect * len(self.data)).from_buffer(self.data)
+
+    def vertices(self, src, texture_size, color=(255,255,255), alpha=255):
+        '''
+        Build a vertex buffer that draws part of a texture into every
+        rectangle, as two triangles per rectangle, for SDL_RenderGeometry
+
+        :param src: RectArray of the same length with the area of the
+            texture to draw into each rectangle
+        :param texture_size: (width, height) of the texture
+        :param color: (r, g, b) color to modulate the texture with
+        :param alpha: alpha value to modulate the texture with
+        :rvalue: a ctypes array of SDL_Vertex, 6 per rectangle
+        '''
+        np = _np
+        vertex = np.dtype([('x', '<f4'), ('y', '<f4'), ('color', 'u1', 4),
+                ('u', '<f4'), ('v', '<f4')])
+        x0, y0 = self.data[:, 0], self.data[:, 1]
+        x1, y1 = self.right, self.bottom
+        tw, th = texture_size
+        u0 = src.data[:, 0] / tw; u1 = src.right / tw
+        v0 = src.data[:, 1] / th; v1 = src.bottom / th
+
+        verts = np.empty((len(self.data), 6), vertex)
+        for i, (x, y, u, v) in enumerate(((x0, y0, u0, v0), (x1, y0, u1, v0),
+                (x0, y1, u0, v1), (x1, y0, u1, v0), (x1, y1, u1, v1),
+                (x0, y1, u0, v1))):
+            verts['x'][:, i] = x; verts['y'][:, i] = y
+            verts['u'][:, i] = u; verts['v'][:, i] = v
+        verts['color'] = tuple(color[:3]) + (alpha,)
+        return (sdl2.SDL_Vertex * verts.size).from_buffer(verts)
+
+    def fill(self, renderer, color):
+        '''
+        Fill every rectangle with one call to SDL
+
+        :param renderer: sdl2.ext.Renderer to draw with
+        :param color: (r, g, b) or (r, g, b, a) color
+        '''
+        if len(self.data):
+            sdl2.SDL_SetRenderDrawColor(renderer.sdlrenderer, *color[:3],
+                    color[3] if len(color) > 3 else 255)
+            sdl2.SDL_RenderFillRects(renderer.sdlrenderer, self.sdl(),
+                    len(self.data))
+
+    def copy_texture(self, renderer, texture, src, color=(255,255,255),
+            alpha=255):
+        '''
+        Draw part of a texture into every rectangle with one call to SDL,
+        such as every glyph of a string. The texture's color and alpha
+        modulation is replaced by color and alpha.
+
+        :param renderer: sdl2.ext.Renderer to draw with
+        :param texture: sdl2.ext.Texture to draw from
+        :param src: RectArray of the same length with the area of the
+            texture to draw into each rectangle
+        :param color: (r, g, b) color to modulate the texture with
+        :param alpha: alpha value to modulate the texture with
+        '''
+        if len(self.data):
+            verts = self.vertices(src, texture.size, color, alpha)
+            sdl2.SDL_RenderGeometry(renderer.sdlrenderer, texture.tx, verts,
+                    len(verts), None, 0)
+
+def _columns(other):
+    'Return the x, y, width and height of a Rect or the columns of a RectArray'
+    if isinstance(other, RectArray):
+        return other.data[:, 0], other.data[:, 1], other.data[:, 2], other.data[:, 3]
+    return other.x, other.y, other.width, other.height
+
+
 class Image():
     renderer = None
     '''
@@ -367,7 +739,7 @@ class Image():
 
         self.texture = texture
         if isinstance(srcrect, Rect):
-            self.srcrect = srcrect.sdl()
+            self.srcrect = sdl2.SDL_Rect(*srcrect.tuple())
         elif isinstance(srcrect, (list, tuple)) and len(srcrect)==4:
             self.srcrect = sdl2.SDL_Rect(*srcrect)
         elif isinstance(srcrect, (sdl2.SDL_Rect)):
@@ -529,6 +901,20 @@ class ImageManager():
             images[name] = im
         return images
     
+    def unload(self, fn):
+        '''
+        Remove an image from the cache and destroy its texture, so the next
+        load() reads the file again
+
+        :param fn: filename(str) the image was loaded with
+        '''
+        self.images.pop(fn, None)
+        texture = self.textures.pop(fn, None)
+        if texture:
+            texture.destroy()
+        if fn in self.cache:
+            self.cache.remove(fn)
+
     def _clean(self):
         'Remove old images when MAX_IMAGES is reached'
         for fn in self.cache[self.MAX_IMAGES:]:
@@ -554,12 +940,55 @@ def get_text_size(font, text=''):
         return text_h.value
     return  text_w.value, text_h.value
 
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB,
+        0xCD, 0xCE, 0xCF} # jpeg markers holding the image size
+
+def image_size(filename):
+    '''
+    Read the width and height of a png, jpeg, gif or bmp image from its
+    header, without loading or decoding the image
+
+    :param filename: path to the image file
+    :rvalue tuple: (width, height), or (None, None) if the file is not
+        an image of a known format
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            head = f.read(26)
+            if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                return struct.unpack('>II', head[16:24])
+            elif head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            elif head[:2] == b'BM':
+                w, h = struct.unpack('<ii', head[18:26])
+                return w, abs(h)
+            elif head[:2] == b'\xff\xd8':
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        break
+                    if marker[1] == 0xFF: # fill byte before a marker
+                        f.seek(-1, 1)
+                        continue
+                    if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD9:
+                        continue # markers without a length
+                    length, = struct.unpack('>H', f.read(2))
+                    if marker[1] in JPEG_SOF:
+                        h, w = struct.unpack('>xHH', f.read(5))
+                        return w, h
+                    f.seek(length - 2, 1)
+    except (OSError, struct.error):
+        pass
+    return None, None
+
 char_map = ''' ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789.,?!-:'"_=+&<^>~@/\\|(%)'''
 class FontManager():
     '''
     The FontManager class loads ttf TODO (otf?) fonts, caches them, and draws text 
     into a sdl2.ext.Renderer context.
     '''
+    MAX_PREFIXES = 256 # maximum number of measured strings to cache
     def __init__(self, renderer):
         '''
         Initialize FontManager for use with pySDL2.ext.Renderer context
@@ -570,6 +999,7 @@ class FontManager():
         self.fonts = {}
         self.cmaps = {}
         self.cache = {}
+        self.prefixes = {}
     def __del__(self):
         for t, h in self.fonts.values():
             t.destroy()
@@ -630,6 +1060,33 @@ class FontManager():
         sdl2.SDL_FreeSurface(surface)
         return filename, size
 
+    def preload(self, filename, size):
+        '''
+        Load a font into the cache without making it the current font, so
+        fonts can be loaded ahead of time without changing what draw() uses
+
+        :param filename: path to a ttf or otf format font file
+        :param size: int point size for font or 'XXpx' for pixel height
+        '''
+        current = getattr(self, 'texture', None), getattr(self, 'height', None), \
+                getattr(self, 'cmap', None), getattr(self, 'blank', None)
+        self.load(filename, size)
+        if current[0] != None:
+            self.texture, self.height, self.cmap, self.blank = current
+
+
+    def unload(self, filename):
+        '''
+        Remove every size of a font from the cache and destroy their
+        textures, so the next load() reads the file again
+
+        :param filename: font filename the font was loaded with
+        '''
+        for key in [k for k in self.fonts if k[0] == filename]:
+            texture, height = self.fonts.pop(key)
+            texture.destroy()
+            self.cmaps.pop(key, None)
+        self.prefixes.clear() # keyed by cmap ids, which may be reused
 
     def draw(self, text, x, y, color=None, alpha=None,
             align='topleft', clip=None, wrap=None, linespace=0, font=None, outline=None):
@@ -643,7 +1100,8 @@ class FontManager():
         :param alpha: alpha transparency value
         :param align: choose one of: topleft, midtop, topright, midleft, center, midright,
                 bottomleft, midbottom, or bottomright
-        :param clip: clip text to Rect
+        :param clip: clip text to Rect. Glyphs outside of it are skipped, and
+                glyphs partly inside of it are clipped by the renderer
         :param wrap: #TODO wrap text over multiple lines, using clip Rect
         :param font: (filename, size) tuple for font, defaults to last_loaded
         :param outline: (color, thickness) or None
@@ -657,6 +1115,7 @@ class FontManager():
         else:
             texture, height = self.texture, self.height
             cmap = self.cmap
+        blank = cmap[' ']
 
         if wrap and not clip: # must have a clip if wrapping
             w = self.renderer.logical_size[0] - x
@@ -681,32 +1140,93 @@ class FontManager():
                         break
             return clip
 
-        out_rect = Rect(0, 0, self.width(text), self.height)
+        widths = self._prefix_widths(text, cmap)
+        out_rect = Rect(0, 0, widths[-1], height)
         dx, dy = getattr(out_rect, align, (0,0))
-        dest = Rect(x-dx, y-dy, 1, self.height)
+        dest = Rect(x-dx, y-dy, 1, height)
         out_rect.topleft = dest.topleft
 
+        # CULL GLYPHS outside of clip, and clip partly visible ones natively
+        first, last, partial = 0, len(text), False
+        if clip:
+            if (dest.y >= clip.bottom or dest.bottom <= clip.y or
+                    dest.x >= clip.right or out_rect.right <= clip.x):
+                return out_rect
+            first = max(0, bisect_right(widths, clip.x - dest.x) - 1)
+            last = min(bisect_left(widths, clip.right - dest.x), len(text))
+            partial = (widths[first] < clip.x - dest.x or
+                    widths[last] > clip.right - dest.x or
+                    dest.y < clip.y or dest.bottom > clip.bottom or outline)
+            dest.x += widths[first]
+        if partial:
+            old_clip = self._set_clip(clip)
+
         sdl2.SDL_SetTextureAlphaMod(texture.tx, alpha or 255)
         color = color or (255,255,255)
         sdl2.SDL_SetTextureColorMod(texture.tx, *color)
 
-        for c in text:
-            src = cmap.get(c, self.blank)
+        if outline:
+            grow = outline[1]; shrink = -outline[1]
+            inflated = Rect(0, 0, 0, 0)
+        for c in text[first:last]:
+            src = cmap.get(c, blank)
             dest.width = src.width
-            if clip and dest.right > clip.right:
-                break
 
             if outline:
                 sdl2.SDL_SetTextureColorMod(texture.tx, *outline[0])
-                self.renderer.copy(texture, src.sdl(), dest.inflated(outline[1]).sdl())
+                inflated.update(dest.x - grow // 2, dest.y - grow // 2,
+                        dest.width + grow, dest.height + grow)
+                self.renderer.copy(texture, src.sdl(), inflated.sdl())
                 sdl2.SDL_SetTextureColorMod(texture.tx, *color)
-                self.renderer.copy(texture, src.sdl(), dest.inflated(-outline[1]).sdl())
+                inflated.update(dest.x - shrink // 2, dest.y - shrink // 2,
+                        dest.width + shrink, dest.height + shrink)
+                self.renderer.copy(texture, src.sdl(), inflated.sdl())
             else:
                 self.renderer.copy(texture, src.sdl(), dest.sdl())
             #self.renderer.draw_rect(dest.tuple(), (255,255,255,255))
             dest.x += src.width
+
+        if partial:
+            sdl2.SDL_RenderSetClipRect(self.renderer.sdlrenderer, old_clip)
         return out_rect
 
+    def _prefix_widths(self, text, cmap):
+        '''
+        Calculate the x offset of each glyph in text, plus the total width
+        at the end, caching the result for recently drawn strings
+
+        :param text: text string to measure
+        :param cmap: character map of the font to measure with
+        :rvalue []: list of len(text)+1 ints, starting with 0
+        '''
+        key = id(cmap), text
+        widths = self.prefixes.get(key)
+        if widths == None:
+            blank = cmap[' ']
+            widths = list(accumulate(
+                    (cmap.get(c, blank).width for c in text), initial=0))
+            if len(self.prefixes) >= self.MAX_PREFIXES:
+                self.prefixes.clear()
+            self.prefixes[key] = widths
+        return widths
+
+    def _set_clip(self, clip):
+        '''
+        Set the renderer's clip rectangle to clip, limited to any clip
+        rectangle that is already set
+
+        :param clip: Rect to clip drawing to
+        :rvalue SDL_Rect or None: the previous clip rectangle, for restoring
+        '''
+        old = sdl2.SDL_Rect()
+        sdl2.SDL_RenderGetClipRect(self.renderer.sdlrenderer, byref(old))
+        if old.w and old.h:
+            clip = clip.clip(Rect.from_sdl(old))
+        else:
+            old = None
+        sdl2.SDL_RenderSetClipRect(self.renderer.sdlrenderer, clip.sdl())
+        return old
+
     def width(self, text, scale=1):
         '''
         Calculate width of given text not including motion or scaling effects
@@ -765,41 +1285,190 @@ class FontManager():
 class SoundManager():
     '''
     The SoundManager class loads and plays sound files.
+
+    Sounds are only decoded the first time they are played and then kept.
+    They play on a pool of CHANNELS mixer channels: when every channel is
+    busy a new sound steals the channel of the oldest sound with the lowest
+    priority, or is skipped if all playing sounds have a higher priority.
+    A sound that already has its limit of voices playing restarts the
+    oldest one instead of stacking another, and is skipped if it was
+    started less than its interval ago, so fast list scrolling never piles
+    up overlapping clicks.
+
+    Bringing audio up can be slow, so init(background=True) loads SDL2_mixer
+    and reads the loaded sound files on a thread while frames are drawn.
+    SDL must initialize audio on the main thread, so poll() then opens the
+    device and runs the queued calls there, from RunLoop.tick() or the next
+    play() or music(). Until then, play() and music() calls follow the
+    policy: 'queue' runs them once audio is ready, 'music' only starts the
+    last requested music, and 'drop' ignores both.
     '''
+    CHANNELS = 16
+    VOICES = 1 # default voices of one sound that may play at once
+    INTERVAL = 30 # default ms before a sound can be restarted
+    FREQUENCY = 44100
+    BUFFER = 1024 # samples per mix, smaller lowers latency but costs CPU
+    POLICY = 'music'
     def __init__(self):
         self.sounds = {}
+        self.samples = {}
+        self.voices = {}
         self.song = None
         self.is_init = False
-
-    def init(self):
+        self.ready = False
+        self.audio = None
+        self.data = {}
+        self.thread = None
+        self.error = None
+        self.policy = self.POLICY
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def init(self, background=False, frequency=None, buffer=None, policy=None):
         '''
-        Initialize the sound system
+        Initialize the sound system. SDL2_mixer is only imported here, so
+        programs without sound never load it.
+
+        :param background: prepare audio on a thread and return at once,
+            leaving poll() to open the device. An error is then printed and
+            kept in error instead of raised
+        :param frequency: sample rate in Hz, SoundManager.FREQUENCY by default
+        :param buffer: samples mixed at a time, SoundManager.BUFFER by default
+        :param policy: 'queue', 'music' or 'drop', to handle play() and
+            music() calls made before audio is ready
         '''
-        if not self.is_init:
-            if sdl2.SDL_Init(sdl2.SDL_INIT_AUDIO) != 0:
-                raise RuntimeError("Cannot initialize audio system: {}".format(SDL_GetError()))
+        if self.is_init or self.thread:
+            return
+        self.policy = policy or self.policy
+        self.audio = frequency or self.FREQUENCY, buffer or self.BUFFER
+        if background:
+            self.thread = threading.Thread(target=self._prepare, daemon=True)
+            self.thread.start()
+        else:
+            import sdl2.sdlmixer
+            self.ready = True
+            self.poll()
+
+    def poll(self):
+        '''
+        Open the audio device once a background init() has prepared it, and
+        run the queued play() and music() calls. It must be called from the
+        main thread, and RunLoop.tick() calls it each frame
 
-            if sdl2.sdlmixer.Mix_OpenAudio(44100, sdl2.sdlmixer.MIX_DEFAULT_FORMAT, 2, 1024):
-                raise RuntimeError(f'Cannot open mixed audio: {sdlmixer.Mix_GetError()}')
+        :rvalue bool: True if audio was started by this call
+        '''
+        if self.is_init or not self.ready:
+            return False
+        try:
+            self._open(*self.audio)
+        except Exception as e:
+            if not self.thread:
+                raise
+            print(e)
+            with self.lock:
+                self.ready = False
+                self.error = e
+                self.pending = []
+            return False
+        with self.lock:
             self.is_init = True
+            pending, self.pending = self.pending, []
+        for name, args in pending:
+            getattr(self, name)(*args)
+        return True
+
+    def _open(self, frequency, buffer):
+        'Initialize audio and open the device on the main thread. Used internally'
+        if sdl2.SDL_InitSubSystem(sdl2.SDL_INIT_AUDIO) != 0:
+            raise RuntimeError("Cannot initialize audio system: {}".format(
+                    sdl2.SDL_GetError()))
+
+        if sdl2.sdlmixer.Mix_OpenAudio(frequency,
+                sdl2.sdlmixer.MIX_DEFAULT_FORMAT, 2, buffer):
+            raise RuntimeError(f'Cannot open mixed audio: {sdl2.sdlmixer.Mix_GetError()}')
+        sdl2.sdlmixer.Mix_AllocateChannels(self.CHANNELS)
+
+    def _prepare(self):
+        '''
+        Thread target that loads SDL2_mixer and reads the files of the loaded
+        sounds into memory, for poll() to finish on the main thread. Used
+        internally
+        '''
+        try:
+            import sdl2.sdlmixer
+            for name, sample in list(self.samples.items()):
+                if name not in self.data:
+                    with open(sample[0], 'rb') as inp:
+                        self.data[name] = inp.read()
+        except Exception as e:
+            print(e)
+            with self.lock:
+                self.error = e
+                self.pending = []
+            return
+        with self.lock:
+            self.ready = True
+
+    def _defer(self, name, *args):
+        '''
+        Queue or drop a play() or music() call made before audio is ready,
+        following the policy. Used internally
+
+        :rvalue bool: False if audio is ready and the call should go ahead
+        '''
+        self.poll()
+        with self.lock:
+            if self.is_init:
+                return False
+            if self.thread and not self.error and (self.policy == 'queue' or
+                    self.policy == 'music' and name == 'music'):
+                if name == 'music':
+                    self.pending = [p for p in self.pending if p[0] != 'music']
+                self.pending.append((name, args))
+        return True
     
-    def load(self, fn, name=None, volume=1):
+    def load(self, fn, name=None, volume=1, priority=0, voices=None,
+            interval=None):
         '''
-        Load a given sound file into the Sound Manager
+        Add a sound file to the Sound Manager. The file is found now but only
+        decoded the first time the sound is played
 
         :param fn: filename for sound file to load
         :param name: alternate name to use to play the sound instead of its filename
         :param volume: default volume level to play the sound at, from 0.0 to 1.0
+        :param priority: sounds with a higher priority steal channels from
+            lower ones when every channel is busy
+        :param voices: number of copies of the sound that may play at once,
+            SoundManager.VOICES by default
+        :param interval: ms before the sound may be restarted,
+            SoundManager.INTERVAL by default
         '''
         file = RESOURCES.get_path(fn)
-        name = name or os.path.splitext(name)[0]
-        sample = sdl2.sdlmixer.Mix_LoadWAV(
-                sdl2.ext.compat.byteify(file, 'utf-8'))
-
-        if sample is None:
-            raise RuntimeError(f'Cannot open audio file: {sdl2.Mix_GetError()}')
-        sdl2.sdlmixer.Mix_VolumeChunk(sample, int(128*volume))
-        self.sounds[name] = sample
+        name = name or os.path.splitext(os.path.basename(fn))[0]
+        if name in self.sounds:
+            sdl2.sdlmixer.Mix_FreeChunk(self.sounds.pop(name))
+        self.data.pop(name, None)
+        self.samples[name] = (file, volume, priority,
+                self.VOICES if voices == None else voices,
+                self.INTERVAL if interval == None else interval)
+
+    def _sample(self, name):
+        'Get the decoded sample of a sound, decoding it on first use. Used internally'
+        sample = self.sounds.get(name)
+        if sample == None and self.is_init and name in self.samples:
+            file, volume = self.samples[name][:2]
+            data = self.data.pop(name, None)
+            if data != None: # read by a background init()
+                sample = sdl2.sdlmixer.Mix_LoadWAV_RW(
+                        sdl2.SDL_RWFromConstMem(data, len(data)), 1)
+            else:
+                sample = sdl2.sdlmixer.Mix_LoadWAV(
+                        sdl2.ext.compat.byteify(file, 'utf-8'))
+            if not sample:
+                raise RuntimeError(f'Cannot open audio file: {sdl2.sdlmixer.Mix_GetError()}')
+            sdl2.sdlmixer.Mix_VolumeChunk(sample, int(128*volume))
+            self.sounds[name] = sample
+        return sample
     
     def music(self, fn, loops=-1, volume=1):
         '''
@@ -809,12 +1478,14 @@ class SoundManager():
         :param loops: number of times to play song, or loop forever by default
         :param volume: volume level to play music, between 0.0 and 1.0
         '''
+        if not self.is_init and self._defer('music', fn, loops, volume):
+            return
         file = RESOURCES.get_path(fn)
         sdl2.sdlmixer.Mix_VolumeMusic(int(volume*128))
         music = sdl2.sdlmixer.Mix_LoadMUS(
                     sdl2.ext.compat.byteify(file, 'utf-8'))
-        if music is None:
-            raise RuntimeError(f'Cannot open audio file: {sdl2.Mix_GetError()}')
+        if not music:
+            raise RuntimeError(f'Cannot open audio file: {sdl2.sdlmixer.Mix_GetError()}')
 
         sdl2.sdlmixer.Mix_PlayMusic(music, loops)
         if self.song:
@@ -829,33 +1500,169 @@ class SoundManager():
         'Set master volume level between 0.0 and 1.0'
         sdl2.sdlmixer.Mix_MasterVolume(int(v*128))
 
-    def play(self, name, volume=1):
+    def play(self, name, volume=1, priority=None):
         '''
-        Play a loaded sound with the given name
+        Play a loaded sound with the given name. Nothing is played if the
+        sound system is not initialized, the sound was restarted less than
+        its interval ago, or every channel is playing a higher priority sound
 
         :param name: name of sound, either the filename(without extension) or
             an alternate name provided to the load() method
         :param volume: volume to play sound at, from 0.0 to 1.
+        :param priority: priority of this sound, or the priority given to
+            load() by default
+        :rvalue int: the channel the sound plays on, or None
         '''
-        sample = self.sounds.get(name)
-        if sample:
-            channel = sdl2.sdlmixer.Mix_PlayChannel(-1, sample, 0)
-            if channel == -1:
-                raise RuntimeError(
-                    f'Cannot play sample {name}: {sdl2.sdlmixer.Mix_GetError()}')
-            sdl2.sdlmixer.Mix_Volume(channel, int(volume*128))
+        if not self.is_init and self._defer('play', name, volume, priority):
+            return None
+        sample = self._sample(name)
+        if not sample:
+            return None
+        file, vol, default, limit, interval = self.samples[name]
+        priority = default if priority == None else priority
+        now = sdl2.SDL_GetTicks()
+        mixer = sdl2.sdlmixer
+
+        playing = [(v[2], c) for c, v in self.voices.items()
+                if v[0] == name and mixer.Mix_Playing(c)]
+        if playing and len(playing) >= limit:
+            if now - max(playing)[0] < interval:
+                return None
+            channel = min(playing)[1] # restart the oldest voice
+        else:
+            channel = -1
+        channel = mixer.Mix_PlayChannel(channel, sample, 0)
+        if channel == -1:
+            channel = self._steal(priority)
+            if channel == None:
+                return None
+            mixer.Mix_PlayChannel(channel, sample, 0)
+        mixer.Mix_Volume(channel, int(volume*128))
+        self.voices[channel] = name, priority, now
+        return channel
+
+    def _steal(self, priority):
+        '''
+        Find the channel of the oldest lowest priority sound that does not
+        outrank priority, or None. Used internally
+        '''
+        voices = [(v[1], v[2], c) for c, v in self.voices.items()
+                if v[1] <= priority]
+        if voices:
+            return min(voices)[2]
 
     def __del__(self):
+        if not self.is_init:
+            return
         for s in self.sounds.values():
             sdl2.sdlmixer.Mix_FreeChunk(s)
         if self.song:
             sdl2.sdlmixer.Mix_FreeMusic(self.song)
 
         sdl2.sdlmixer.Mix_CloseAudio()
-        sdl2.SDL_Quit(sdl2.SDL_INIT_AUDIO)
+        sdl2.SDL_QuitSubSystem(sdl2.SDL_INIT_AUDIO)
         print('SoundManager closed')
 sounds = SoundManager()
 
+
+class Startup():
+    '''
+    Records a timeline of the startup phases of a program and runs the
+    startup tasks that were deferred until after the first frame. gui.init()
+    records its phases here, and defers audio, music, the game controller
+    and font loading when started lazily. RunLoop.present() marks the first
+    frame and RunLoop.tick() then runs one deferred task per frame, so the
+    first frame is shown as soon as the window is ready and the GUI stays
+    responsive while the rest comes up.
+
+        with startup.phase('load level'):
+            ...
+        startup.defer('music', sounds.music, 'song.ogg')
+        ...
+        startup.report()
+
+    Times are in milliseconds since pySDL2gui was imported.
+    '''
+    def __init__(self):
+        self.start = perf_counter()
+        self.spans = []
+        self.tasks = deque()
+        self.first_frame = None
+
+    def phase(self, name):
+        '''
+        Return a context manager that records the time spent in its block
+
+        :param name: name of the phase in the report
+        '''
+        return _Phase(self, name)
+
+    def mark(self, name):
+        '''
+        Record a moment on the timeline, such as the first frame
+
+        :param name: name of the moment in the report
+        '''
+        t = perf_counter()
+        self.spans.append((name, t, t))
+
+    def defer(self, name, func, *args):
+        '''
+        Run a startup task after the first frame has been presented
+
+        :param name: name of the task in the report
+        :param func: function to call
+        :param args: arguments to call func with
+        '''
+        self.tasks.append((name, func, args))
+
+    def frame(self):
+        'Called after each presented frame, marking the first one'
+        if self.first_frame == None:
+            self.first_frame = perf_counter()
+            self.mark('first frame')
+
+    def run_next(self):
+        '''
+        Run the next deferred task. Tasks wait until the first frame has been presented.
+        '''
+        if self.tasks and self.first_frame != None:
+            name, func, args = self.tasks.popleft()
+            with self.phase(name + ' (deferred)'):
+                func(*args)
+
+    def finish(self):
+        'Run all remaining deferred tasks now, even before the first frame'
+        while self.tasks:
+            name, func, args = self.tasks.popleft()
+            with self.phase(name + ' (deferred)'):
+                func(*args)
+
+    def report(self, file=None):
+        '''
+        Print the startup timeline
+
+        :param file: file object to print to, sys.stdout by default
+        '''
+        file = file or sys.stdout
+        print(f'{"start ms":>10}{"time ms":>10}  phase', file=file)
+        for name, t0, t1 in sorted(self.spans, key=lambda s: s[1]):
+            print(f'{(t0-self.start)*1000:10.1f}{(t1-t0)*1000:10.1f}  {name}',
+                    file=file)
+        if self.tasks:
+            print(f'{len(self.tasks)} deferred task(s) still waiting', file=file)
+
+class _Phase():
+    'Context manager returned by Startup.phase()'
+    def __init__(self, startup, name):
+        self.startup = startup
+        self.name = name
+    def __enter__(self):
+        self.t = perf_counter()
+    def __exit__(self, *exc):
+        self.startup.spans.append((self.name, self.t, perf_counter()))
+startup = Startup()
+
 from collections.abc import Mapping
 def deep_update(d, u, r=False):
     '''
@@ -877,6 +1684,80 @@ def deep_update(d, u, r=False):
             o[k] = u[k]
     return o
 
+class Layers(Mapping):
+    '''
+    A read-only view of several dicts layered over each other, such as
+    defaults, theme and instance parameters. A key is looked up from the
+    highest layer down, and when its value is a dict, the dicts found under
+    that key in lower layers are returned as another Layers, so nested dicts
+    are merged without copying anything. A value that is not a dict hides
+    everything below it, like deep_update() would.
+
+    Layers never change the dicts they view. To change values, put them in
+    a dict layered on top, Layers(view, {'fill': [0,0,0]}), or make a plain
+    dict copy of the view with copy() and change that.
+
+    layers: dicts or Layers, from lowest to highest priority. None is skipped
+    '''
+    __slots__ = ('layers',)
+    def __init__(self, *layers):
+        self.layers = () # highest priority first, like ChainMap.maps
+        for layer in layers:
+            if isinstance(layer, Layers):
+                self.layers = layer.layers + self.layers
+            elif layer != None:
+                self.layers = (layer,) + self.layers
+
+    def get(self, key, default=None):
+        nested = None
+        for layer in self.layers:
+            v = layer.get(key, _MISSING)
+            if v is _MISSING:
+                continue
+            if not isinstance(v, (dict, Layers)):
+                if nested:
+                    break
+                return v
+            if nested == None:
+                nested = []
+            nested.insert(0, v)
+        if nested == None:
+            return default
+        return Layers(*nested)
+
+    def __getitem__(self, key):
+        v = self.get(key, _MISSING)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, key):
+        for layer in self.layers:
+            if key in layer:
+                return True
+        return False
+
+    def __iter__(self):
+        return iter(dict.fromkeys(
+                k for layer in reversed(self.layers) for k in layer))
+
+    def __len__(self):
+        return len(set().union(*self.layers))
+
+    def __repr__(self):
+        return f'Layers{self.layers!r}'
+
+    def copy(self):
+        '''
+        Make a plain dict of the merged view, copying nested dicts and lists,
+        that may be changed without affecting any layer
+
+        :rvalue dict: the merged copy
+        '''
+        return {k: v.copy() if isinstance(v, (Layers, list)) else v
+                for k, v in self.items()}
+_MISSING = object()
+
 def deep_merge(d, u, r=False):
     '''
     Add contents of dict u into a copy of dict d. This will not change the
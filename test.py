@@ -5,7 +5,7 @@ from gui import *
 image_path = '/home/michael/Roms/genesis/media/images'
 
 
-def main():
+async def main(stack):
     background = Region(config['background'])
     mainlist = Region(config['mainlist'])
     maininfo = Region(config['maininfo'])
@@ -14,33 +14,36 @@ def main():
 
     blist = list(buttons.keys()) ; picked = 0 ; where = Rect(340,240, 90,90)
 
+    runner = TaskRunner(inp)
+    loop = stack.loop
     update = True
     running = 1
     while running:
         running += 1
-        inp.process()
-        update = mainlist.update(inp) or update
+        await loop.tick()
 
         if inp.quit:
             running = False
-        if inp.pressed:
-            #print(inp.pressed)
-            if inp.pressed in ('A', 'start'):
+        update = mainlist.update(inp, True) or update
+        for t, pressed in inp.drain():
+            update = mainlist.handle(pressed) or update
+            if pressed in ('A', 'start'):
                 update = True
                 selected = mainlist.list[mainlist.selected]
                 if selected == 'Exit':
                     running = 0
                 elif selected == 'Install Port':
                     sounds.play('click')
-                    game_list()
+                    await stack.show(game_list, runner)
                 elif selected == "Onscreen Keyboard":
-                    print(key_test('default'))
+                    print(await stack.show(key_test, 'default'))
                 elif selected == "Option Menu":
-                    option_test()
-            elif inp.pressed == 'right':
+                    await stack.show(option_test)
+                break # the screen shown handled the input that followed
+            elif pressed == 'right':
                 picked += 1
                 update = True
-            elif inp.pressed == 'left':
+            elif pressed == 'left':
                 picked -= 1
                 update = True
             picked = picked % len(blist)
@@ -60,15 +63,15 @@ def main():
             buttons[blist[picked]].draw_in(r.sdl())
             fonts.draw(blist[picked], 340, 400, color=(0,0,0))
 
-            screen.present()
+            loop.present()
 
-        sdl2.timer.SDL_Delay(1000//30)
         update = False
 
+    runner.shutdown()
     screen.destroy()
     return 0
 
-def key_test(text):
+def key_test(loop, text, on_change=None, regions=[]):
     key1 = [
         '1234567890',
         'qwertyuiop',
@@ -91,10 +94,11 @@ def key_test(text):
         "barspace": 0,
         "barwidth": 50,
         "roundness": 12}
-    return keyboard(d, key1, key2, text)
+    return (yield from keyboard_screen(loop, d, key1, key2, text, on_change,
+            regions))
 
 
-def option_test():
+def option_test(loop):
     region = {
             "area": [.05,0.2,0.95,0.95],
             "fill": [230,230,230],
@@ -120,12 +124,12 @@ def option_test():
         "Nothing": None,
         "Labels": None
         }
-    r = option_menu(region, options, config['background'])
+    r = yield from option_menu_screen(loop, region, options, config['background'])
     
-def game_list():
+def game_list(loop, runner):
     #global config, screen, fonts, images, inp
-    files = sorted([os.path.join(image_path,f) for f in os.listdir(image_path) if f.endswith('.png')])
-    names = [os.path.splitext(os.path.split(f)[-1])[0] for f in files]
+    media = MediaIndex(image_path, ('.png',)) # cached entries are listed at once
+    media.scan(runner)
 
     background = Region(config['background'])
     gamelist = Region(config['gamelist'])
@@ -137,43 +141,84 @@ def game_list():
     if 'gamebar' in config:
         gamebar = Region(config['gamebar'])
 
-    background.text = names[0]
-    gamelist.list = names
+    files = media.entries
+    gamelist.list = listing = ListView(media.names, range(len(media.names)))
+    index = None
+
+    def search(text):
+        nonlocal index, files
+        if index == None or index.items is not media.names:
+            index = ListIndex(media.names)
+        view = index.filter(text)
+        if len(view):
+            gamelist.list = view
+            files = media.entries
+            gamelist.selected = 0
 
     running = update = 1
     while running:
-        inp.process()
-        running = 1 if gamelist.update(inp) else running + 1
-
-        if inp.quit:
-            running = 0
-        if inp.pressed:
-            if inp.pressed == 'right':
+        yield
+        running += 1
+        if inp.tasks and media.update() and gamelist.list is listing:
+            files = media.entries # list the files found by the scan
+            gamelist.list = listing = ListView(media.names, range(len(media.names)))
+            update = True
+        if not len(gamelist.list):
+            if inp.quit or any(pressed in ('start', 'select')
+                    for t, pressed in inp.drain()):
+                return
+            if update or inp.update:
+                background.draw()
+                loop.present()
+            update = False
+            continue
+
+        if gamelist.update(inp, True):
+            running = 1
+        for t, pressed in inp.drain():
+            if gamelist.handle(pressed):
+                running = 1
+            elif pressed == 'right':
                 gamelist.selected += gamelist.page_size
                 sounds.play('click')
                 running = 1
-            elif inp.pressed == 'left':
+            elif pressed == 'left':
                 gamelist.selected -= gamelist.page_size
                 sounds.play('click')
                 running = 1
-            elif inp.pressed in ('start', 'select'):
+            elif pressed in ('L', 'R'):
+                step = 1 if pressed == 'R' else -1
+                gamelist.selected = gamelist.list.jump(gamelist.selected, step)
+                sounds.play('click')
+                running = 1
+            elif pressed == 'Y':
+                yield from key_test(loop, '', search, [gamelist])
+                running = 1
+                break
+            elif pressed in ('start', 'select'):
                 running = 0
+                break
+        if inp.quit:
+            running = 0
 
+        selected = gamelist.list.source_index(gamelist.selected % len(gamelist.list))
         if running == 1:
-            background.text = names[gamelist.selected % len(gamelist.list)]
+            background.text = files[selected].name
             update = True
             gametext.text = ''
             gameimage.image = None
-        elif running == 20:
-            im = images.load(files[gamelist.selected])
+        if running < 20 or gametext.autoscroll:
+            loop.wake() # count frames until the image loads, and autoscroll
+        if running == 20:
+            im = images.load(files[selected].path)
             gameimage.image = im
-            gametext.text = files[gamelist.selected].replace('/', ' ') * 5
+            gametext.text = files[selected].path.replace('/', ' ') * 5
             update = True
         
         if gametext.update(inp):
             update = True
         
-        if update:
+        if update or inp.update:
             background.draw()
             gametext.draw()
             gameimage.draw()
@@ -181,11 +226,22 @@ def game_list():
                 gamebar.draw()
             gamelist.draw()
 
-            screen.present()
-        sdl2.timer.SDL_Delay(1000//30)
+            loop.present()
         update = False
 
+def argument(name):
+    'Return the command line argument following name, or None'
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+
 if __name__ == "__main__":
     config, screen, fonts, images, inp = init()
-    main()
+    if argument('record'):
+        inp.record(argument('record'))
+    if argument('replay'):
+        # headless: SDL_VIDEODRIVER=dummy SDL_AUDIODRIVER=dummy python test.py window replay FILE
+        print(json.dumps(replay_session(argument('replay'), screen, inp,
+                ScreenStack().run, main), indent=2))
+    else:
+        ScreenStack().run(main)
     sys.exit()
\ No newline at end of file